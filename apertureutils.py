@@ -0,0 +1,153 @@
+import numpy as np
+from matplotlib.path import Path
+
+
+def box_mask(shape, x0, x1, y0, y1):
+    # spaxels whose centres fall in the box, in data coordinates
+    ny, nx = shape
+    mask = np.zeros(shape, dtype=bool)
+    mask[max(int(np.ceil(min(y0, y1))), 0):min(int(np.floor(max(y0, y1))) + 1, ny),
+         max(int(np.ceil(min(x0, x1))), 0):min(int(np.floor(max(x0, x1))) + 1, nx)] = True
+    return mask
+
+def ellipse_mask(shape, x0, x1, y0, y1):
+    # spaxels whose centres fall in the ellipse inscribed in the box
+    xc, yc = 0.5*(x0 + x1), 0.5*(y0 + y1)
+    a, b = max(0.5*abs(x1 - x0), 0.5), max(0.5*abs(y1 - y0), 0.5)
+    y, x = np.indices(shape)
+    return ((x - xc)/a)**2 + ((y - yc)/b)**2 <= 1.
+
+def polygon_mask(shape, verts):
+    # spaxels whose centres fall in the polygon of (x, y) vertices
+    y, x = np.indices(shape)
+    inside = Path(verts).contains_points(np.column_stack([x.ravel(), y.ravel()]))
+    return inside.reshape(shape)
+
+def mask_runs(mask):
+    """Split a 2D mask into runs of consecutive spaxels along x.
+
+    Returns the rows and the first and last + 1 columns of every run.
+    """
+    padded = np.zeros((mask.shape[0], mask.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    edges = np.diff(padded, axis=1)
+    ys, x0s = np.nonzero(edges == 1)
+    _, x1s = np.nonzero(edges == -1)
+    return ys, x0s, x1s
+
+def direct_sum(datacube, varcube, channels, mask, nplanes=64):
+    """Same sums as ApertureIndex.mask_sum, read straight from the cubes.
+
+    Only the bounding box of the mask is read, nplanes channels at a time
+    and one run of consecutive channels after another, so the cost grows
+    with the number of channels times the area of the box.
+    """
+    channels = np.asarray(channels)
+    nchan = len(channels)
+    flux, var = np.zeros(nchan), np.zeros(nchan)
+    count = np.zeros(nchan, dtype=np.int32)
+    ys, xs = np.nonzero(mask)
+    if nchan == 0 or len(ys) == 0:
+        return flux, var, count
+    y0, y1, x0, x1 = ys.min(), ys.max() + 1, xs.min(), xs.max() + 1
+    inside = mask[y0:y1, x0:x1]
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(channels) > 1) + 1])
+    ends = np.append(starts[1:], nchan)
+    for start, end in zip(starts, ends):
+        for i0 in range(start, end, nplanes):
+            i1 = min(i0 + nplanes, end)
+            w0, w1 = channels[i0], channels[i1 - 1] + 1
+            data = np.asarray(datacube[w0:w1, y0:y1, x0:x1], dtype=float)[:, inside]
+            v = np.asarray(varcube[w0:w1, y0:y1, x0:x1], dtype=float)[:, inside]
+            good = np.isfinite(data) & np.isfinite(v)
+            flux[i0:i1] = np.where(good, data, 0.).sum(axis=1)
+            var[i0:i1] = np.where(good, v, 0.).sum(axis=1)
+            count[i0:i1] = good.sum(axis=1)
+    return flux, var, count
+
+class ApertureIndex():
+    """Summed-area tables of a cube for fast aperture spectra.
+
+    For each of the given channels, table[c, y, x] holds the sum of the
+    cube over [0:y, 0:x], so the sum over any rectangle takes four lookups
+    per channel, whatever its area. Tables are kept for the data, the
+    variance and the number of finite spaxels (NaNs are left out of the
+    sums). Other apertures are split into runs along x, one lookup of four
+    per run and channel. The tables are built nplanes channels at a time.
+
+    The sums are accumulated in float64 and stored as dtype (4 bytes per
+    channel and spaxel each with float32, plus 4 for the counts). The mean
+    of every channel is taken out first and added back for each valid
+    spaxel, so the tables only hold the departures from it. Rounding each
+    entry then errs by at most u*max|table| (u = eps/2, 6e-8 for float32),
+    and the lookups are done in float64, so a box sum is within 4 of these
+    (flux_error and var_error, per channel) and a mask sum within 4 per run.
+    """
+    def __init__(self, datacube, varcube, channels, nplanes=32, dtype=np.float32):
+        self.channels = np.asarray(channels)
+        nwave, ny, nx = datacube.shape
+        nchan = len(self.channels)
+        self.shape = (ny, nx)
+        self.flux = np.zeros((nchan, ny + 1, nx + 1), dtype=dtype)
+        self.var = np.zeros((nchan, ny + 1, nx + 1), dtype=dtype)
+        self.count = np.zeros((nchan, ny + 1, nx + 1), dtype=np.int32)
+        self.flux_mean, self.var_mean = np.zeros(nchan), np.zeros(nchan)
+        self.flux_error, self.var_error = np.zeros(nchan), np.zeros(nchan)
+        u = np.finfo(dtype).eps/2
+
+        for i0 in range(0, nchan, nplanes):
+            chans = self.channels[i0:i0+nplanes]
+            i1 = i0 + len(chans)
+            # read the contiguous block of planes once, then pick the channels
+            w0, w1 = chans[0], chans[-1] + 1
+            data = np.asarray(datacube[w0:w1], dtype=float)[chans - w0]
+            var = np.asarray(varcube[w0:w1], dtype=float)[chans - w0]
+            good = np.isfinite(data) & np.isfinite(var)
+            np.cumsum(np.cumsum(good, axis=1), axis=2, out=self.count[i0:i1, 1:, 1:])
+            n = np.maximum(good.sum(axis=(1, 2)), 1)
+            for table, mean, error, cube in [(self.flux, self.flux_mean, self.flux_error, data),
+                                             (self.var, self.var_mean, self.var_error, var)]:
+                cube = np.where(good, cube, 0.)
+                mean[i0:i1] = cube.sum(axis=(1, 2))/n
+                cube = np.where(good, cube - mean[i0:i1, None, None], 0.)
+                sat = np.cumsum(np.cumsum(cube, axis=1), axis=2)
+                table[i0:i1, 1:, 1:] = sat
+                error[i0:i1] = 4*u*np.abs(sat).max(axis=(1, 2))
+
+    @staticmethod
+    def table_nbytes(nchan, shape, dtype=np.float32):
+        # memory taken by the tables of nchan channels of a (ny, nx) cube
+        ny, nx = shape
+        return nchan*(ny + 1)*(nx + 1)*(2*np.dtype(dtype).itemsize + 4)
+
+    @property
+    def nbytes(self):
+        return self.flux.nbytes + self.var.nbytes + self.count.nbytes
+
+    def _rect_sums(self, y0, y1, x0, x1):
+        # sums over the rectangles [y0:y1, x0:x1], added up
+        sums = []
+        for table in [self.flux, self.var, self.count]:
+            s = (table[:, y1, x1].astype(float) - table[:, y0, x1] - table[:, y1, x0] + table[:, y0, x0])
+            sums.append(s.sum(axis=1) if s.ndim == 2 else s)
+        flux, var, count = sums
+        count = count.astype(np.int64)
+        return flux + self.flux_mean*count, var + self.var_mean*count, count
+
+    def box_sum(self, y0, y1, x0, x1):
+        """Sum of the flux and variance, and the number of spaxels, in [y0:y1, x0:x1]."""
+        return self._rect_sums(y0, y1, x0, x1)
+
+    def mask_sum(self, mask):
+        """Same as box_sum for the spaxels of a 2D mask."""
+        ys, x0s, x1s = mask_runs(mask)
+        return self._rect_sums(ys, ys + 1, x0s, x1s)
+
+def combine(flux, var, count, stat='mean'):
+    # mean or summed spectrum and its variance from the sums of an
+    # aperture, NaN where no spaxel is valid
+    with np.errstate(invalid='ignore', divide='ignore'):
+        n = np.where(count > 0, count, np.nan)
+        if stat == 'mean':
+            return flux/n, var/n**2
+        return np.where(count > 0, flux, np.nan), np.where(count > 0, var, np.nan)
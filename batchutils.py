@@ -0,0 +1,277 @@
+import os
+import re
+import warnings
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from astropy.io import fits
+import numpy as np
+
+
+def process_pool(nproc=None, **kwargs):
+    # pool for the work started from the viewer: spawned rather than forked,
+    # as forking with the prefetcher and click worker threads running can
+    # copy their locks in a held state into the workers
+    return ProcessPoolExecutor(max_workers=nproc, mp_context=multiprocessing.get_context('spawn'),
+                               **kwargs)
+
+def iter_tiles(ny, nx, tile):
+    for y0 in range(0, ny, tile):
+        for x0 in range(0, nx, tile):
+            yield y0, min(y0 + tile, ny), x0, min(x0 + tile, nx)
+
+def model_spectra(model, wave, popts, nsigma=5.):
+    """Evaluate the total model of every spaxel in popts (npar, nspax) on wave.
+
+    model is a model_display function as returned by return_models(). The
+    model and model_display of line complexes from modelutils are evaluated
+    in one vectorized call, other models (e.g. model_nolsf_display) one
+    spaxel at a time.
+    """
+    obj = getattr(model, '__self__', None)
+    if hasattr(obj, 'model_spectra') and getattr(model, '__name__', '') in ['model', 'model_display']:
+        return obj.model_spectra(wave, popts, nsigma=nsigma)
+
+    popts = np.asarray(popts, dtype=float).reshape(popts.shape[0], -1)
+    out = np.empty((popts.shape[1], len(wave)))
+    for i in range(popts.shape[1]):
+        m = model(wave, *popts[:, i])
+        out[i] = m[0] if isinstance(m, (tuple, list)) else m
+    return out
+
+def model_display_sum(model, x, popts):
+    """Sum of model(x, *popt) over the spaxels of popts (npar, nspax).
+
+    model is a model_display function as returned by return_models(), and
+    the result has the same form as its return value. The model_display of
+    a line complex is evaluated for all spaxels at once.
+    """
+    obj = getattr(model, '__self__', None)
+    if hasattr(obj, 'model_display_sum') and getattr(model, '__name__', '') == 'model_display':
+        return obj.model_display_sum(x, popts)
+
+    popts = np.asarray(popts, dtype=float).reshape(popts.shape[0], -1)
+    total = None
+    for i in range(popts.shape[1]):
+        m = model(x, *popts[:, i])
+        if isinstance(m, (tuple, list)):
+            total = list(m) if total is None else [t + c for t, c in zip(total, m)]
+        else:
+            total = m if total is None else total + m
+    return tuple(total) if isinstance(total, list) else total
+
+def _synth_tile(model, wave, popts, data, nsigma):
+    npar, ty, tx = popts.shape
+    model_tile = model_spectra(model, wave, popts.reshape(npar, -1), nsigma)
+    model_tile = model_tile.T.reshape(len(wave), ty, tx)
+    return model_tile.astype(np.float32), (data - model_tile).astype(np.float32)
+
+_WCS_KEY = re.compile(r'^(WCSAXES|RADESYS|EQUINOX|LONPOLE|LATPOLE|SPECSYS|MJD-OBS|DATE-OBS|'
+                      r'(CTYPE|CUNIT|CRVAL|CRPIX|CDELT|CROTA)\d|(CD|PC)\d_\d)$')
+
+def cube_header(data):
+    """WCS header for a cube on the (possibly cropped) wave grid of data.
+
+    The WCS keywords of the cube are copied as they are (astropy's WCS
+    would turn CD3_3 into PC3_3 in metres, which _set_wave cannot read) and
+    the spectral axis starts at the first channel kept.
+    """
+    header = fits.Header([card for card in data.header.cards if _WCS_KEY.match(card.keyword)])
+    if not isinstance(data.wave_sel, slice):
+        warnings.warn('wavelength selection is not contiguous, '
+                      'the spectral WCS of the output cube is not valid')
+    header['CRVAL3'] = float(data.wave[0])
+    header['CRPIX3'] = 1.
+    return header
+
+def create_fits_cube(fname, shape, header=None, dtype=np.float32):
+    """Create an empty FITS cube of the given (nwave, ny, nx) shape on disk.
+
+    The file is written without ever holding the cube in memory and is
+    returned opened in update mode, so tiles can be streamed into its
+    memory-mapped data.
+    """
+    nwave, ny, nx = shape
+    hdu = fits.PrimaryHDU(data=np.zeros((1, 1, 1), dtype=dtype))
+    h = hdu.header
+    h['NAXIS1'], h['NAXIS2'], h['NAXIS3'] = nx, ny, nwave
+    if header is not None:
+        h.extend(header, update=True)
+    h.tofile(fname, overwrite=True)
+
+    nbytes = nwave*ny*nx*np.dtype(dtype).itemsize
+    with open(fname, 'rb+') as f:
+        f.seek(len(h.tostring()) + int(np.ceil(nbytes/2880.))*2880 - 1)
+        f.write(b'\0')
+    return fits.open(fname, mode='update', memmap=True)
+
+def write_model_cube(model, popts, data, model_fname, resid_fname=None,
+                     tile=32, nsigma=5., nproc=None):
+    """Write the model cube of one panel, and the residual cube data - model.
+
+    The field is processed in tile x tile blocks of spaxels spread over
+    nproc processes, and each block is written into the memory-mapped
+    output files as soon as it is done, so memory use depends on the tile
+    size and not on the size of the cube. Lines are only evaluated within
+    nsigma of their centre.
+    """
+    nwave, ny, nx = data.datacube.shape
+    header = cube_header(data)
+    model_hdul = create_fits_cube(model_fname, (nwave, ny, nx), header)
+    resid_hdul = None
+    if resid_fname is not None:
+        resid_hdul = create_fits_cube(resid_fname, (nwave, ny, nx), header)
+
+    if nproc is None: nproc = os.cpu_count()
+    with ProcessPoolExecutor(max_workers=nproc) as executor:
+        nmax = 2*nproc
+        pending = []
+        for y0, y1, x0, x1 in iter_tiles(ny, nx, tile):
+            popts_tile = np.asarray(popts[:, y0:y1, x0:x1], dtype=float)
+            data_tile = np.asarray(data.datacube[:, y0:y1, x0:x1], dtype=float)
+            future = executor.submit(_synth_tile, model, data.wave, popts_tile,
+                                     data_tile, nsigma)
+            pending.append(((y0, y1, x0, x1), future))
+            # keep a bounded number of tiles in flight
+            while len(pending) >= nmax:
+                _write_tile(pending.pop(0), model_hdul, resid_hdul)
+        while pending:
+            _write_tile(pending.pop(0), model_hdul, resid_hdul)
+
+    for hdul in [model_hdul, resid_hdul]:
+        if hdul is not None:
+            hdul.close()
+
+def _write_tile(item, model_hdul, resid_hdul):
+    (y0, y1, x0, x1), future = item
+    model_tile, resid_tile = future.result()
+    model_hdul[0].data[:, y0:y1, x0:x1] = model_tile
+    if resid_hdul is not None:
+        resid_hdul[0].data[:, y0:y1, x0:x1] = resid_tile
+
+def get_panel_chi2_window(chi2_window, ipanel):
+    # chi2_window is either one (2*nwindow, ny, nx) cube shared by all
+    # panels or one such cube per panel
+    if chi2_window is None:
+        return None
+    if isinstance(chi2_window, np.ndarray) and chi2_window.ndim == 3:
+        return chi2_window
+    return chi2_window[ipanel]
+
+def build_window_index(chi2_window, npanels, shape):
+    """Chi2 windows of every panel and spaxel as one (ny, nx, npanels, nwindow, 2) array.
+
+    chi2_window is None, one (2*nwindow, ny, nx) cube shared by all panels
+    or a list with one such cube (or None) per panel. Panels with fewer
+    windows than the others are padded with NaN.
+    """
+    ny, nx = shape
+    cubes = [get_panel_chi2_window(chi2_window, ipanel) for ipanel in range(npanels)]
+    nwindow = max([0] + [int(c.shape[0]/2) for c in cubes if c is not None])
+    index = np.full((ny, nx, npanels, nwindow, 2), np.nan)
+    for ipanel, cube in enumerate(cubes):
+        if cube is None: continue
+        n = int(cube.shape[0]/2)
+        index[:, :, ipanel, :n] = np.asarray(cube, dtype=float).reshape(n, 2, ny, nx).transpose(2, 3, 0, 1)
+    return index
+
+def normalize_bad_regions(bad_region_masks, npanels):
+    # [w0, w1, w0, w1, ...] per panel (or no list at all) as one
+    # (npanels, nbad, 2) array padded with NaN
+    regions = [np.asarray(bad_region_masks[ipanel] if len(bad_region_masks) > 0 else [],
+                          dtype=float).reshape(-1, 2) for ipanel in range(npanels)]
+    out = np.full((npanels, max([0] + [len(r) for r in regions]), 2), np.nan)
+    for ipanel, r in enumerate(regions):
+        out[ipanel, :len(r)] = r
+    return out
+
+def _tile_channels(wave, window_tile, wrange):
+    # channels spanned by all the chi2 windows of a tile
+    if window_tile is None:
+        lo, hi = wrange
+    else:
+        lo, hi = window_tile[0::2], window_tile[1::2]
+        if not (np.isfinite(lo).any() and np.isfinite(hi).any()):
+            return slice(0, 0)
+        lo, hi = np.nanmin(lo), np.nanmax(hi)
+    return slice(np.searchsorted(wave, lo), np.searchsorted(wave, hi, side='right'))
+
+def _tile_mask(wave, d, m, err2, window_tile, wrange, bad_regions):
+    # (nspax, nwave) channels inside the chi2 windows (or wrange), outside
+    # the bad regions, with finite data and model and positive errors
+    if window_tile is None:
+        mask = np.broadcast_to((wave > wrange[0]) & (wave < wrange[1]), d.shape)
+    else:
+        w = window_tile.reshape(-1, 2, d.shape[0])
+        mask = np.any((wave >= w[:, 0, :, None]) & (wave <= w[:, 1, :, None]), axis=0)
+    for ibad in range(int(len(bad_regions)/2)):
+        mask = mask & ~((wave >= bad_regions[ibad*2]) & (wave <= bad_regions[ibad*2+1]))
+    return mask & np.isfinite(d) & np.isfinite(m) & (err2 > 0)
+
+def _stats_tile(model, wave, popts, data, var, window_tile, wrange, bad_regions,
+                rescale_noise, nsigma):
+    npar, ty, tx = popts.shape
+    nspax = ty*tx
+    d = data.reshape(len(wave), nspax).T
+    err2 = var.reshape(len(wave), nspax).T*rescale_noise**2
+    m = model_spectra(model, wave, popts.reshape(npar, nspax), nsigma)
+    mask = _tile_mask(wave, d, m, err2, window_tile, wrange, bad_regions)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        chi2 = np.where(mask, (d - m)**2/err2, 0.).sum(axis=1)
+        n = mask.sum(axis=1)
+        chi2_nu = np.where(n > npar, chi2/(n - npar), np.nan)
+        bic = np.where(n > 0, chi2 + npar*np.log(n), np.nan)
+    return chi2_nu.reshape(ty, tx), bic.reshape(ty, tx)
+
+def compute_fit_stats(model, popts, data, chi2_window=None, wrange=None,
+                      bad_regions=(), tile=32, nsigma=5., nproc=None):
+    """Reduced chi2 and BIC maps of one panel's model.
+
+    chi2 is summed over the channels inside the per-spaxel chi2 windows
+    (2*nwindow, ny, nx), or inside wrange = (wmin, wmax) if there are no
+    windows, leaving out the bad regions [w0, w1, w0, w1, ...]. The errors
+    are sqrt(var)*rescale_noise with the current rescale_noise of the data,
+    and the number of free parameters is the length of popts. Only the
+    channels spanned by the windows are read from the cube, tile x tile
+    spaxels at a time, on nproc processes.
+    """
+    nwave, ny, nx = data.datacube.shape
+    chi2_map = np.full((ny, nx), np.nan)
+    bic_map = np.full((ny, nx), np.nan)
+    rescale_noise = data.errcube.rescale_noise
+
+    if nproc is None: nproc = os.cpu_count()
+    with process_pool(nproc) as executor:
+        futures = []
+        for y0, y1, x0, x1 in iter_tiles(ny, nx, tile):
+            window_tile = None
+            if chi2_window is not None:
+                window_tile = np.asarray(chi2_window[:, y0:y1, x0:x1], dtype=float)
+            sel = _tile_channels(data.wave, window_tile, wrange)
+            future = executor.submit(_stats_tile, model, data.wave[sel],
+                        np.asarray(popts[:, y0:y1, x0:x1], dtype=float),
+                        np.asarray(data.datacube[sel, y0:y1, x0:x1], dtype=float),
+                        np.asarray(data.varcube[sel, y0:y1, x0:x1], dtype=float),
+                        window_tile, wrange, bad_regions, rescale_noise, nsigma)
+            futures.append(((y0, y1, x0, x1), future))
+        for (y0, y1, x0, x1), future in futures:
+            chi2_map[y0:y1, x0:x1], bic_map[y0:y1, x0:x1] = future.result()
+    return chi2_map, bic_map
+
+def compute_all_fit_stats(models, model_popts, data, chi2_window, bad_region_masks,
+                          config_params, nproc=None):
+    # chi2 and BIC maps of every panel, with the panel windows from config_params
+    chi2_maps, bic_maps = [], []
+    for ipanel in range(config_params.npanels):
+        bad_regions = bad_region_masks[ipanel] if len(bad_region_masks) > 0 else []
+        chi2_map, bic_map = compute_fit_stats(models[ipanel], model_popts[ipanel], data,
+                                get_panel_chi2_window(chi2_window, ipanel),
+                                (config_params.wmins[ipanel], config_params.wmaxs[ipanel]),
+                                bad_regions, nproc=nproc)
+        chi2_maps.append(chi2_map)
+        bic_maps.append(bic_map)
+    return chi2_maps, bic_maps
+
+def delta_bic(bic_maps, ipanel, jpanel):
+    # BIC of panel ipanel minus BIC of panel jpanel, > 0 where jpanel is preferred
+    return bic_maps[ipanel] - bic_maps[jpanel]
@@ -0,0 +1,229 @@
+import os
+import json
+import time
+import types
+import platform
+import argparse
+import tempfile
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+from astropy.io import fits
+from fitviz.config import DefineParams
+from fitviz.datautils import Data, write_spaxel_store
+from fitviz.modelutils import (get_model_popts, get_chi2_maps, get_bic_maps,
+                               O2_1comp, O2_2comp, O3_1comp, O3_2comp, O3_3comp,
+                               O3_4comp, O3_5comp)
+from fitviz.batchutils import compute_fit_stats
+from fitviz.displayutils import Displays
+
+O2_LINES = [3727.092, 3729.875]
+O3_LINES = [4960.295, 5008.240]
+Z0 = 0.5335
+LSF = [55., 52.]
+
+# model name, class, rest wavelengths, parameters of one component
+MODELS = [('O2_1comp', O2_1comp, O2_LINES, 1, [Z0, 80., 5., 1.3]),
+          ('O2_2comp', O2_2comp, O2_LINES, 2, [Z0, 80., 5., 1.3]),
+          ('O3_1comp', O3_1comp, O3_LINES, 1, [Z0, 80., 5.]),
+          ('O3_2comp', O3_2comp, O3_LINES, 2, [Z0, 80., 5.]),
+          ('O3_3comp', O3_3comp, O3_LINES, 3, [Z0, 80., 5.]),
+          ('O3_4comp', O3_4comp, O3_LINES, 4, [Z0, 80., 5.]),
+          ('O3_5comp', O3_5comp, O3_LINES, 5, [Z0, 80., 5.])]
+
+# panels of the synthetic config: model name, wmin, wmax
+PANELS = [('O2_1comp', 5690, 5750), ('O3_1comp', 7560, 7730), ('O3_2comp', 7560, 7730),
+          ('O3_3comp', 7560, 7730), ('O2_2comp', 5690, 5750), ('O3_5comp', 7560, 7730)]
+
+
+def component_params(comp_params, ncomp):
+    # spread the components in velocity so they do not coincide
+    params = []
+    for i in range(ncomp):
+        p = list(comp_params)
+        p[0] += 2e-4*i
+        params += p
+    return params
+
+def make_synthetic_products(outdir, ny, nx, nwave, seed=1):
+    """Write a MUSE-like cube, 2D map, popts, chi2, BIC and chi2-window files.
+
+    Returns the name of a data config file that points to them.
+    """
+    rng = np.random.default_rng(seed)
+    wave = 4750. + 1.25*np.arange(nwave)
+    h = fits.Header()
+    h['CTYPE1'], h['CTYPE2'], h['CTYPE3'] = 'RA---TAN', 'DEC--TAN', 'AWAV'
+    h['CRVAL3'], h['CD3_3'], h['CRPIX3'] = wave[0], 1.25, 1.
+    h['CD1_1'], h['CD2_2'] = -5.5e-5, 5.5e-5
+
+    # fill the cube in chunks of planes to limit temporary arrays
+    cube_fname = os.path.join(outdir, 'cube.fits')
+    hdul = fits.HDUList([fits.PrimaryHDU(),
+                         fits.ImageHDU(np.zeros((1, ny, nx), dtype='>f4'), header=h, name='DATA'),
+                         fits.ImageHDU(np.zeros((1, ny, nx), dtype='>f4'), header=h, name='STAT')])
+    hdul[1].data = np.empty((nwave, ny, nx), dtype='>f4')
+    hdul[2].data = np.empty((nwave, ny, nx), dtype='>f4')
+    for w0 in range(0, nwave, 256):
+        w1 = min(w0 + 256, nwave)
+        hdul[1].data[w0:w1] = rng.normal(0., 1., (w1 - w0, ny, nx))
+        hdul[2].data[w0:w1] = 1.
+    hdul.writeto(cube_fname, overwrite=True)
+    del hdul
+
+    fits.writeto(os.path.join(outdir, 'vmap.fits'),
+                 rng.normal(0., 50., (ny, nx)).astype('>f4'), overwrite=True)
+    for name, cls, lines, ncomp, comp_params in MODELS:
+        params = component_params(comp_params, ncomp)
+        popts = np.array(params)[:, None, None]*np.ones((len(params), ny, nx))
+        popts[0::len(comp_params)] += rng.normal(0., 1e-4, (ncomp, ny, nx))
+        fits.writeto(os.path.join(outdir, name + '.fits'), popts, overwrite=True)
+    for ipanel in range(len(PANELS)):
+        fits.writeto(os.path.join(outdir, 'chi2_%d.fits' % ipanel),
+                     rng.uniform(0.5, 2., (ny, nx)), overwrite=True)
+        fits.writeto(os.path.join(outdir, 'bic_%d.fits' % ipanel),
+                     rng.uniform(100., 200., (ny, nx)), overwrite=True)
+    window = np.empty((2, ny, nx))
+    window[0], window[1] = 7640., 7690.
+    fits.writeto(os.path.join(outdir, 'chi2_window.fits'), window, overwrite=True)
+
+    npanels = len(PANELS)
+    lines = ['map_path {}/'.format(outdir),
+             'cube_path {}/'.format(outdir),
+             'map_fname vmap.fits',
+             'cube_fname cube.fits',
+             'vmin vmax -80 185',
+             "color_bar_label 'Velocity (km/s)'",
+             'xmin xmax 0 {}'.format(nx),
+             'ymin ymax 0 {}'.format(ny),
+             'wmin wmax 5000 9200',
+             'rescale_noise 1.6',
+             'fast_render True',
+             'npanels {}'.format(npanels),
+             'wmins ' + ' '.join(str(p[1]) for p in PANELS),
+             'wmaxs ' + ' '.join(str(p[2]) for p in PANELS),
+             'panel_titles ' + ' '.join("'{}'".format(p[0].replace('_', ' ')) for p in PANELS),
+             'model_path ' + ' '.join([outdir + '/']*npanels),
+             'model_fname ' + ' '.join(p[0] + '.fits' for p in PANELS),
+             'chi2_path ' + ' '.join([outdir + '/']*npanels),
+             'chi2_fname ' + ' '.join('chi2_%d.fits' % i for i in range(npanels)),
+             'bic_path ' + ' '.join([outdir + '/']*npanels),
+             'bic_fname ' + ' '.join('bic_%d.fits' % i for i in range(npanels))]
+    config_fname = os.path.join(outdir, 'data_config.dat')
+    with open(config_fname, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return config_fname
+
+def synthetic_model_config(outdir):
+    # stands in for a model_config.py file
+    classes = dict((m[0], (m[1], m[2])) for m in MODELS)
+    window = fits.getdata(os.path.join(outdir, 'chi2_window.fits'))
+    def return_models():
+        models = []
+        for name, wmin, wmax in PANELS:
+            cls, lines = classes[name]
+            models.append(cls(lines, LSF).model_display)
+        return models
+    return types.SimpleNamespace(
+        return_models=return_models,
+        return_bad_region_masks=lambda: [[] for p in PANELS],
+        return_chi2_window=lambda: window)
+
+def timeit(func, n, setup=None):
+    times = []
+    for i in range(n):
+        args = setup(i) if setup is not None else ()
+        t0 = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - t0)
+    times = np.array(times)*1e3
+    return {'n': n, 'mean_ms': times.mean(), 'median_ms': float(np.median(times)),
+            'min_ms': times.min(), 'max_ms': times.max()}
+
+def run_benchmarks(config_fname, outdir, nrepeat):
+    results = {}
+    config_params = DefineParams(config_fname)
+    # time the work itself, not reads from a warm session cache
+    config_params.session_cache = None
+    cube_fullpath = config_params.cube_path + config_params.cube_fname
+    rng = np.random.default_rng(2)
+
+    def load(lazy):
+        config_params.lazy_load = lazy
+        return Data(config_params)
+    results['load_eager'] = timeit(lambda: load(False), nrepeat)
+    results['load_lazy'] = timeit(lambda: load(True), nrepeat)
+
+    datas = [('eager', load(False)), ('lazy', load(True))]
+    results['convert_spaxel_store'] = timeit(lambda: write_spaxel_store(cube_fullpath), 1)
+    results['load_store'] = timeit(lambda: load(True), nrepeat)
+    datas.append(('store', load(True)))
+
+    for name, data in datas:
+        nwave, ny, nx = data.datacube.shape
+        def random_spaxel(i):
+            return rng.integers(ny), rng.integers(nx)
+        results['spaxel_' + name] = timeit(
+            lambda y, x: (np.asarray(data.datacube[:, y, x]), data.errcube[:, y, x]),
+            20*nrepeat, random_spaxel)
+
+    for name, cls, lines, ncomp, comp_params in MODELS:
+        model = cls(lines, LSF)
+        params = component_params(comp_params, ncomp)
+        center = np.mean(lines)*(1. + Z0)
+        x = np.arange(center - 85., center + 85., 0.1)
+        results['model_' + name] = timeit(lambda: model.model_display(x, *params), 20*nrepeat)
+        popts = np.array(params)[:, None]*np.ones((len(params), 1024))
+        results['model_spectra_1024_' + name] = timeit(
+            lambda: model.model_spectra(datas[-1][1].wave, popts), nrepeat)
+
+    data = datas[-1][1]
+    model_config = synthetic_model_config(outdir)
+    model_popts = get_model_popts(config_params)
+    results['fit_stats_panel'] = timeit(
+        lambda: compute_fit_stats(model_config.return_models()[2], model_popts[2], data,
+                                  model_config.return_chi2_window(), (7560, 7730)), nrepeat)
+
+    for cached in [False, True]:
+        config_params.payload_cache_mb = 256. if cached else 0.
+        config_params.prefetch = False
+        displays = Displays(config_params, data, model_popts, get_chi2_maps(config_params),
+                            get_bic_maps(config_params), model_config=model_config,
+                            headless=True)
+        displays.show_figures()
+        nwave, ny, nx = data.datacube.shape
+        spaxels = [(rng.integers(ny), rng.integers(nx)) for i in range(5)]
+        # with the cache, revisit a few spaxels as when inspecting a region
+        results['panel_refresh' + ('_cached' if cached else '')] = timeit(
+            displays.show_spaxel, 10*nrepeat, lambda i: spaxels[i % len(spaxels)])
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the data, model and display layers on a synthetic cube.')
+    parser.add_argument('--ny', type=int, default=100)
+    parser.add_argument('--nx', type=int, default=100)
+    parser.add_argument('--nwave', type=int, default=3700)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workdir', default=None, help='where to write the synthetic files (default: a temporary directory)')
+    parser.add_argument('--output', default='benchmark_{}.json'.format(time.strftime('%Y%m%d_%H%M%S')))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        outdir = os.path.abspath(args.workdir or tmpdir)
+        os.makedirs(outdir, exist_ok=True)
+        config_fname = make_synthetic_products(outdir, args.ny, args.nx, args.nwave)
+        results = run_benchmarks(config_fname, outdir, args.repeat)
+
+    report = {'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'machine': platform.node(), 'python': platform.python_version(),
+              'numpy': np.__version__, 'matplotlib': matplotlib.__version__,
+              'cube_shape': [args.nwave, args.ny, args.nx], 'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1, default=float)
+
+    for name, r in results.items():
+        print('{:32s} {:10.3f} ms (median of {})'.format(name, r['median_ms'], r['n']))
+    print('wrote {}'.format(args.output))
+
+if __name__ == '__main__':
+    main()
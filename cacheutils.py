@@ -0,0 +1,239 @@
+import os
+import json
+import hashlib
+import threading
+import warnings
+from collections import OrderedDict
+import numpy as np
+
+
+def nbytes(obj):
+    """Approximate memory used by arrays in nested lists, tuples and dicts."""
+    if isinstance(obj, np.ndarray) or hasattr(obj, 'nbytes'):
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sum(nbytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(nbytes(v) for v in obj)
+    return 8
+
+class LRUCache():
+    """Thread-safe least-recently-used cache with a memory budget in bytes.
+
+    Entries are evicted, oldest first, as soon as the total size of the
+    cached values goes over max_bytes. hits and misses count get() calls.
+    clear() bumps generation: a value computed from data that has changed
+    since is put with the generation read before computing it, and dropped.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key, value, size=None, generation=None):
+        if size is None: size = nbytes(value)
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                self.nbytes -= self._entries.popitem(last=False)[1][1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+            self.generation += 1
+
+class Prefetcher():
+    """Background thread that fills an LRUCache with compute(key).
+
+    request() replaces any keys still waiting with a new list, so the
+    worker always works on the neighbourhood of the latest request.
+    """
+    def __init__(self, compute, cache):
+        self.compute = compute
+        self.cache = cache
+        self._keys = []
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def request(self, keys):
+        with self._cond:
+            self._keys = [key for key in keys if key not in self.cache]
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._keys:
+                    self._cond.wait()
+                key = self._keys.pop(0)
+            if key in self.cache:
+                continue
+            # anything computed from here on sees the data after a clear()
+            generation = self.cache.generation
+            try:
+                self.cache.put(key, self.compute(key), generation=generation)
+            except Exception as e:
+                warnings.warn('prefetching {} failed: {}'.format(key, e))
+
+class LatestWorker():
+    """Background thread that computes compute(key) for the latest request only.
+
+    request() replaces a key still waiting, so a burst of requests computes
+    the first and the last one only. poll() returns (key, result, error) of
+    the latest request once it is done, or None; results of requests made
+    before it, or before cancel(), are dropped. With a cache, a result
+    computed before cache.clear() is dropped too and computed again.
+    """
+    def __init__(self, compute, cache=None):
+        self.compute = compute
+        self.cache = cache
+        self._serial = 0
+        self._pending = None
+        self._running = None
+        self._done = None
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def ident(self):
+        return self._thread.ident
+
+    @property
+    def busy(self):
+        # True while the latest request is waiting or being computed
+        with self._cond:
+            return self._pending is not None or self._running == self._serial
+
+    def request(self, key):
+        with self._cond:
+            self._serial += 1
+            self._pending = (self._serial, key)
+            self._done = None
+            self._cond.notify()
+
+    def cancel(self):
+        with self._cond:
+            self._serial += 1
+            self._pending = self._done = None
+
+    def _generation(self):
+        return self.cache.generation if self.cache is not None else 0
+
+    def poll(self):
+        with self._cond:
+            done, self._done = self._done, None
+            if done is not None and done[3] != self._generation():
+                self._serial += 1
+                self._pending = (self._serial, done[0])
+                self._cond.notify()
+                return None
+        return None if done is None else done[:3]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is None:
+                    self._cond.wait()
+                serial, key = self._pending
+                self._pending = None
+                self._running = serial
+            generation = self._generation()
+            result, error = None, None
+            try:
+                result = self.compute(key)
+            except Exception as e:
+                error = e
+            with self._cond:
+                self._running = None
+                if serial == self._serial:
+                    self._done = (key, result, error, generation)
+
+def fingerprint(paths):
+    # path, size and mtime of every file, as JSON-friendly lists
+    out = []
+    for path in paths:
+        st = os.stat(path)
+        out.append([os.path.abspath(path), st.st_size, st.st_mtime])
+    return out
+
+class SessionCache():
+    """On-disk cache of arrays read or derived from files, kept between sessions.
+
+    Every entry is a native-endian .npy file, memory-mapped when it is read
+    back, and a .json file with the path, size and mtime of its source
+    files and an optional extra key. An entry is only used while all of
+    them match; otherwise it is computed again and replaced.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _entry(self, name):
+        digest = hashlib.sha1(name.encode()).hexdigest()[:16]
+        base = os.path.join(self.cache_dir, '{}_{}'.format(os.path.basename(name), digest))
+        return base + '.npy', base + '.json'
+
+    def get(self, name, sources, compute, extra=''):
+        """Array compute() cached under name, for the given source files."""
+        npy_fname, meta_fname = self._entry(name)
+        meta = {'name': name, 'sources': fingerprint(sources), 'extra': extra}
+        try:
+            with open(meta_fname) as f:
+                if json.load(f) == meta:
+                    return np.load(npy_fname, mmap_mode='r')
+        except (OSError, ValueError):
+            pass
+
+        arr = np.asarray(compute())
+        arr = arr.astype(arr.dtype.newbyteorder('='), copy=False)
+        try:
+            # the metadata goes last, so a half-written entry is never used
+            if os.path.exists(meta_fname): os.remove(meta_fname)
+            tmp_fname = '{}.{}.tmp'.format(npy_fname, os.getpid())
+            with open(tmp_fname, 'wb') as f:
+                np.save(f, arr)
+            os.replace(tmp_fname, npy_fname)
+            with open(meta_fname, 'w') as f:
+                json.dump(meta, f)
+        except OSError as e:
+            warnings.warn('could not write session cache entry {}: {}'.format(npy_fname, e))
+        return arr
+
+def get_session_cache(config_params):
+    if config_params.session_cache is None:
+        return None
+    try:
+        return SessionCache(config_params.session_cache)
+    except OSError as e:
+        warnings.warn('session cache disabled: {}'.format(e))
+        return None
@@ -8,6 +8,8 @@ class DefineParams():
         # Read and filter empty lines
         all_lines = filter(None,(line.rstrip() for line in open(config_fname)))
 
+        self.extra_maps = []
+
         # Remove commented lines
         self.lines = []
         for line in all_lines:
@@ -59,6 +61,50 @@ class DefineParams():
                 self.rescale_noise = float(line[1])
             if 'panel_titles' in line:
                 self.panel_titles = re.findall('\'([^\']*)\'', line_str)
+            if 'lazy_load' in line:
+                self.lazy_load = line[1].lower() in ['true', '1', 'yes']
+            if 'crop_wave' in line:
+                self.crop_wave = line[1].lower() in ['true', '1', 'yes']
+            if 'crop_margin' in line:
+                self.crop_margin = float(line[1])
+            if 'refresh_rate' in line:
+                self.refresh_rate = float(line[1])
+            if 'hover_crosshair' in line:
+                self.hover_crosshair = line[1].lower() in ['true', '1', 'yes']
+            if 'payload_cache_mb' in line:
+                self.payload_cache_mb = float(line[1])
+            if 'fast_render' in line:
+                self.fast_render = line[1].lower() in ['true', '1', 'yes']
+            if 'recompute_stats' in line:
+                self.recompute_stats = line[1].lower() in ['true', '1', 'yes']
+            if 'lsf_fname' in line:
+                self.lsf_fname = line[1]
+            if 'prefetch' in line:
+                self.prefetch = line[1].lower() in ['true', '1', 'yes']
+            if 'timing_log' in line:
+                self.timing_log = None if line[1] == 'None' else line[1]
+            if 'profile_clicks' in line:
+                self.profile_clicks = int(line[1])
+            if 'cube_cache_mb' in line:
+                self.cube_cache_mb = float(line[1])
+            if 'cube_tile' in line:
+                self.cube_tile = int(line[1])
+            if 'quality_index' in line:
+                self.quality_index = line[1].lower() in ['true', '1', 'yes']
+            if 'quality_top' in line:
+                self.quality_top = int(line[1])
+            if 'aperture_stat' in line:
+                self.aperture_stat = line[1]
+            if 'aperture_max_models' in line:
+                self.aperture_max_models = int(line[1])
+            if 'aperture_max_mb' in line:
+                self.aperture_max_mb = float(line[1])
+            if 'session_cache' in line:
+                self.session_cache = None if line[1] == 'None' else line[1]
+            if 'extra_map' in line:
+                label = re.findall('\'([^\']*)\'', line_str)
+                self.extra_maps.append((line[1], line[2], line[3],
+                                        label[0] if label else line[1]))
 
         if not hasattr(self, 'map_path'):
             self.map_path = self.cube_path
@@ -66,4 +112,44 @@ class DefineParams():
             self.chi2_path = None
         if not hasattr(self, 'bic_path'):
             self.bic_path = None
+        if not hasattr(self, 'lazy_load'):
+            self.lazy_load = False
+        if not hasattr(self, 'crop_wave'):
+            self.crop_wave = False
+        if not hasattr(self, 'crop_margin'):
+            self.crop_margin = 20.
+        if not hasattr(self, 'refresh_rate'):
+            self.refresh_rate = 60.
+        if not hasattr(self, 'hover_crosshair'):
+            self.hover_crosshair = False
+        if not hasattr(self, 'payload_cache_mb'):
+            self.payload_cache_mb = 256.
+        if not hasattr(self, 'fast_render'):
+            self.fast_render = False
+        if not hasattr(self, 'recompute_stats'):
+            self.recompute_stats = False
+        if not hasattr(self, 'lsf_fname'):
+            self.lsf_fname = None
+        if not hasattr(self, 'prefetch'):
+            self.prefetch = True
+        if not hasattr(self, 'timing_log'):
+            self.timing_log = 'fitviz_timing.log'
+        if not hasattr(self, 'profile_clicks'):
+            self.profile_clicks = 10
+        if not hasattr(self, 'cube_cache_mb'):
+            self.cube_cache_mb = 0.
+        if not hasattr(self, 'cube_tile'):
+            self.cube_tile = 16
+        if not hasattr(self, 'quality_index'):
+            self.quality_index = False
+        if not hasattr(self, 'quality_top'):
+            self.quality_top = 1000
+        if not hasattr(self, 'session_cache'):
+            self.session_cache = '~/.cache/fitviz'
+        if not hasattr(self, 'aperture_stat'):
+            self.aperture_stat = 'mean'
+        if not hasattr(self, 'aperture_max_models'):
+            self.aperture_max_models = 2500
+        if not hasattr(self, 'aperture_max_mb'):
+            self.aperture_max_mb = 1024.
             
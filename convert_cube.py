@@ -0,0 +1,11 @@
+import sys
+from fitviz.datautils import write_spaxel_store
+
+def main():
+	# write a spaxel-major copy of the cube that Data picks up automatically
+	cube_fullpath = sys.argv[1]
+	store_path = write_spaxel_store(cube_fullpath)
+	print('wrote {}'.format(store_path))
+
+if __name__ == '__main__':
+	main()
@@ -1,26 +1,372 @@
 from astropy.io import fits
-import numpy as np 
+import numpy as np
+import warnings
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from fitviz.cacheutils import LRUCache
 
 
 # need: init_map, cube, wave
 class Data():
-    def __init__(self, config_params):
+    def __init__(self, config_params, products=None):
         self.config_params = config_params
 
         map_fullpath = config_params.map_path + config_params.map_fname
-        self.init_map = fits.getdata(map_fullpath)
+        if products is not None and map_fullpath in products:
+            self.init_map = products[map_fullpath]
+        else:
+            self.init_map = fits.getdata(map_fullpath)
+
+        # extra 2D maps read from files, by name in the data config
+        self.maps = {}
+        for name, path in get_map_paths(config_params).items():
+            if products is not None and path in products:
+                self.maps[name] = products[path]
+            else:
+                self.maps[name] = fits.getdata(path)
 
-        # read cube data and close it after getting the values
         cube_fullpath = config_params.cube_path + config_params.cube_fname
-        hdul = fits.open(cube_fullpath)
+        store = read_spaxel_store(cube_fullpath)
+        if store is not None:
+            self._read_cube_store(cube_fullpath, store)
+        elif config_params.lazy_load or config_params.cube_cache_mb > 0:
+            self._read_cube_lazy(cube_fullpath)
+        else:
+            self._read_cube(cube_fullpath)
+
+        # spectra are read through a shared cache of spatial tiles
+        self.tile_cache = None
+        if config_params.cube_cache_mb > 0:
+            self.tile_cache = LRUCache(config_params.cube_cache_mb*2**20)
+            self.datacube = TiledCube(self.datacube, self.tile_cache, 'data', config_params.cube_tile)
+            self.varcube = TiledCube(self.varcube, self.tile_cache, 'var', config_params.cube_tile)
+            tile_bytes = 2*self.datacube.dtype.itemsize*len(self.wave)*config_params.cube_tile**2
+            if tile_bytes > self.tile_cache.max_bytes:
+                warnings.warn('cube_cache_mb is smaller than one tile of data and variance '
+                              '({:.1f} MB), spectra will be read from the cube every time'.format(
+                              tile_bytes/2**20))
+
+        self.errcube = ErrorCube(self.varcube, config_params.rescale_noise)
+
+    def _read_cube(self, cube_fullpath):
+        # read cube data and close it after getting the values; with
+        # crop_wave the channels are selected on the memory-mapped file, so
+        # that only the planes kept are read into memory
+        hdul = fits.open(cube_fullpath, memmap=True)
         if len(hdul) < 3: warnings.warn('datacube missing variance extension')
 
-        self.datacube = hdul[1].data
-        self.varcube = hdul[2].data
+        self._set_wave(hdul[1].header)
+        if self.config_params.crop_wave:
+            self.wave_sel = self.get_wave_selection(self.wave)
+            self.wave = self.wave[self.wave_sel]
+        self.datacube = np.array(hdul[1].data[self.wave_sel])
+        self.varcube = np.array(hdul[2].data[self.wave_sel])
+
+        hdul.close()
+
+    def _read_cube_lazy(self, cube_fullpath):
+        # memory-map SCI and VAR and keep the file open, so that pages are
+        # only read from disk when a spaxel is actually sliced
+        self._hdul = fits.open(cube_fullpath, memmap=True, mode='readonly',
+                               lazy_load_hdus=True)
+        if len(self._hdul) < 3: warnings.warn('datacube missing variance extension')
 
-        h = hdul[1].header
+        for ext in [1, 2]:
+            h = self._hdul[ext].header
+            if h.get('BSCALE', 1) != 1 or h.get('BZERO', 0) != 0:
+                warnings.warn('extension {} is scaled, it will be read into memory'.format(ext))
+
+        self.datacube = self._hdul[1].data
+        self.varcube = self._hdul[2].data
+        self._set_wave(self._hdul[1].header)
+        if self.config_params.crop_wave:
+            self._crop_wave()
+
+    def _read_cube_store(self, cube_fullpath, store):
+        # the store is (y, x, wave), transposing back gives a (wave, y, x)
+        # view in which every [:, y, x] spectrum is one contiguous read
+        data, var = store
+        self.datacube = data.transpose(2, 0, 1)
+        self.varcube = var.transpose(2, 0, 1)
+        self._set_wave(fits.getheader(cube_fullpath, 1))
+        if self.config_params.crop_wave:
+            self._crop_wave()
+
+    def _set_wave(self, h):
+        self.header = h
         self.wave = h['CRVAL3'] + h['CD3_3']*np.arange(h['NAXIS3'])
+        self.wave_sel = slice(None)
 
-        hdul.close()
+    def get_wave_selection(self, wave):
+        """Return the channels of wave that fall in any of the display windows.
+
+        The windows are wmin-wmax and all the per-panel wmins-wmaxs, each
+        padded by crop_margin. A slice is returned if the selected channels
+        are contiguous, so that memory-mapped cubes stay memory-mapped.
+        """
+        cp = self.config_params
+        margin = cp.crop_margin
+        windows = [(cp.wmin, cp.wmax)] + list(zip(cp.wmins, cp.wmaxs))
+        keep = np.zeros(len(wave), dtype=bool)
+        for w0, w1 in windows:
+            keep |= (wave >= w0 - margin) & (wave <= w1 + margin)
+        idx = np.flatnonzero(keep)
+        if len(idx) == 0:
+            raise ValueError('no channel of the cube falls in the display windows')
+        if idx[-1] - idx[0] + 1 == len(idx):
+            return slice(int(idx[0]), int(idx[-1]) + 1)
+        return idx
+
+    def _crop_wave(self):
+        self.wave_sel = self.get_wave_selection(self.wave)
+        self.datacube = self.datacube[self.wave_sel]
+        self.varcube = self.varcube[self.wave_sel]
+        self.wave = self.wave[self.wave_sel]
+
+    def cache_stats(self):
+        # one line on the use of the tile cache, to size cube_cache_mb
+        c = self.tile_cache
+        if c is None:
+            return ''
+        nget = c.hits + c.misses
+        return 'cube cache {:.0f}/{:.0f} MB, {} tiles, {:.0f}% hits'.format(
+               c.nbytes/2**20, c.max_bytes/2**20, len(c), 100.*c.hits/nget if nget else 0.)
+
+    def close(self):
+        if getattr(self, '_hdul', None) is not None:
+            self._hdul.close()
+            self._hdul = None
+
+class TiledCube():
+    """(wave, y, x) cube whose spectra are read tile x tile spaxels at a time.
+
+    cube[:, y, x] (or any channel selection at one spaxel) loads the whole
+    tile around the spaxel from the backing cube, a memory-mapped FITS
+    extension or spaxel store, into an LRUCache shared with other cubes;
+    neighbouring spaxels are then served from memory. Tiles are kept as
+    native-endian (y, x, wave) blocks, so every spectrum is contiguous. The
+    least recently used tiles are dropped when the cache is over its byte
+    budget, and everything but single spectra goes straight to the backing
+    cube, so memory use stays bounded whatever the size of the cube.
+    """
+    def __init__(self, cube, cache, name, tile=16):
+        self.cube = cube
+        self.cache = cache
+        self.name = name
+        self.tile = tile
+
+    @property
+    def shape(self):
+        return self.cube.shape
+
+    @property
+    def ndim(self):
+        return self.cube.ndim
+
+    @property
+    def dtype(self):
+        return self.cube.dtype
+
+    def get_tile(self, ty, tx):
+        key = (self.name, ty, tx)
+        block = self.cache.get(key)
+        if block is None:
+            t = self.tile
+            block = np.asarray(self.cube[:, ty*t:(ty+1)*t, tx*t:(tx+1)*t])
+            block = np.ascontiguousarray(block.transpose(1, 2, 0),
+                                         dtype=block.dtype.newbyteorder('='))
+            self.cache.put(key, block)
+        return block
+
+    def __getitem__(self, key):
+        if (isinstance(key, tuple) and len(key) == 3 and
+                isinstance(key[1], (int, np.integer)) and
+                isinstance(key[2], (int, np.integer))):
+            y, x = int(key[1]), int(key[2])
+            ny, nx = self.shape[1:]
+            if not (0 <= y < ny and 0 <= x < nx):
+                raise IndexError('spaxel ({}, {}) is outside the cube'.format(y, x))
+            t = self.tile
+            return self.get_tile(y//t, x//t)[y % t, x % t][key[0]]
+        return self.cube[key]
+
+
+class ErrorCube():
+    """Error cube sqrt(var)*rescale_noise, computed one spaxel at a time.
+
+    Indexing as errcube[:, y, x] returns the error spectrum of a spaxel, and
+    the unscaled errors of the most recent spaxels are kept in a small cache,
+    so rescale_noise can be changed at any time without recomputing anything.
+    """
+    def __init__(self, varcube, rescale_noise=1., cache_size=64):
+        self.varcube = varcube
+        self.rescale_noise = rescale_noise
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def shape(self):
+        return self.varcube.shape
+
+    @property
+    def ndim(self):
+        return self.varcube.ndim
+
+    def spectrum(self, y, x):
+        key = (y, x)
+        with self._lock:
+            err = self._cache.get(key)
+            if err is not None:
+                self._cache.move_to_end(key)
+        if err is None:
+            err = np.sqrt(self.varcube[:, y, x])
+            with self._lock:
+                self._cache[key] = err
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return err*self.rescale_noise
+
+    def __getitem__(self, key):
+        if (isinstance(key, tuple) and len(key) == 3 and
+                isinstance(key[1], (int, np.integer)) and
+                isinstance(key[2], (int, np.integer))):
+            return self.spectrum(int(key[1]), int(key[2]))[key[0]]
+        return np.sqrt(self.varcube[key])*self.rescale_noise
+
+    def compute(self, nthreads=None, nplanes=64):
+        """Compute the full error cube, nplanes wavelength planes at a time.
+
+        numpy releases the GIL in sqrt, so the chunks run in parallel on
+        nthreads cores (all of them by default).
+        """
+        nwave = self.varcube.shape[0]
+        errcube = np.empty(self.varcube.shape, dtype=self.varcube.dtype.newbyteorder('='))
+
+        def _compute_chunk(w0):
+            np.sqrt(self.varcube[w0:w0+nplanes], out=errcube[w0:w0+nplanes])
+            errcube[w0:w0+nplanes] *= self.rescale_noise
+
+        with ThreadPoolExecutor(max_workers=nthreads) as executor:
+            list(executor.map(_compute_chunk, range(0, nwave, nplanes)))
+        return errcube
+
+
+def get_map_paths(config_params):
+    # extra maps that are files, as opposed to chi2:<ipanel> and the like
+    return dict((name, config_params.map_path + name) for name, vmin, vmax, label
+                in config_params.extra_maps if ':' not in name)
+
+def get_product_paths(config_params):
+    # every 2D map and model file referenced by the data config, without
+    # duplicates; chi2 and BIC files are left out if they are recomputed
+    paths = [config_params.map_path + config_params.map_fname]
+    paths += list(get_map_paths(config_params).values())
+    keys = [('model_path', 'model_fname')]
+    if not config_params.recompute_stats:
+        keys += [('chi2_path', 'chi2_fname'), ('bic_path', 'bic_fname')]
+    for path_key, fname_key in keys:
+        dirs = getattr(config_params, path_key)
+        if dirs is None: continue
+        fnames = getattr(config_params, fname_key)
+        paths += [dirs[i] + fnames[i] for i in range(len(dirs))]
+    return list(dict.fromkeys(paths))
+
+def load_products(config_params, nthreads=8, verbose=True, session_cache=None):
+    """Read all the files referenced by the data config concurrently.
+
+    Each distinct path is read into memory once, on a pool of nthreads
+    threads (reads are dominated by I/O, which releases the GIL), and the
+    time of each read is printed. Returns a dict from full path to array,
+    which get_model_popts, get_chi2_maps, get_bic_maps and Data take to skip
+    reading the files again. With a SessionCache, files that have not
+    changed since the last session are memory-mapped from their
+    native-endian copies in the cache instead, which only opens them.
+    """
+    def _read(path):
+        return np.array(fits.getdata(path, memmap=True))
+
+    def _load(path):
+        t0 = time.perf_counter()
+        if session_cache is not None:
+            arr = session_cache.get(path, [path], lambda: _read(path))
+        else:
+            arr = _read(path)
+        return arr, time.perf_counter() - t0
+
+    paths = get_product_paths(config_params)
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=nthreads) as executor:
+        results = list(executor.map(_load, paths))
+
+    products = {}
+    for path, (arr, dt) in zip(paths, results):
+        products[path] = arr
+        if verbose: print('{:8.3f} s  {}'.format(dt, path))
+    if verbose:
+        print('{:8.3f} s  total for {} files'.format(time.perf_counter() - t0, len(paths)))
+    return products
+
+
+def get_spaxel_store_path(cube_fullpath):
+    return cube_fullpath + '.spaxel'
+
+def _source_fingerprint(cube_fullpath):
+    st = os.stat(cube_fullpath)
+    return {'source_size': st.st_size, 'source_mtime': st.st_mtime}
+
+def write_spaxel_store(cube_fullpath, store_path=None, nrows=8):
+    """Write a spaxel-major (y, x, wave) copy of SCI and VAR next to the cube.
+
+    The cube is converted nrows image rows at a time, so memory use stays at
+    a few rows of the cube. The metadata file is written last and records the
+    size and mtime of the source, so an interrupted conversion or a modified
+    cube is never picked up by read_spaxel_store.
+    """
+    if store_path is None: store_path = get_spaxel_store_path(cube_fullpath)
+    os.makedirs(store_path, exist_ok=True)
+    meta_fname = os.path.join(store_path, 'meta.json')
+    if os.path.exists(meta_fname): os.remove(meta_fname)
+
+    with fits.open(cube_fullpath, memmap=True, mode='readonly') as hdul:
+        if len(hdul) < 3: raise ValueError('datacube missing variance extension')
+        nwave, ny, nx = hdul[1].data.shape
+        for ext, name in [(1, 'data.npy'), (2, 'var.npy')]:
+            cube = hdul[ext].data
+            out = np.lib.format.open_memmap(os.path.join(store_path, name), mode='w+',
+                        dtype=cube.dtype.newbyteorder('='), shape=(ny, nx, nwave))
+            for y0 in range(0, ny, nrows):
+                out[y0:y0+nrows] = cube[:, y0:y0+nrows, :].transpose(1, 2, 0)
+            out.flush()
+            del out
+
+    meta = _source_fingerprint(cube_fullpath)
+    meta['shape'] = [nwave, ny, nx]
+    with open(meta_fname, 'w') as f:
+        json.dump(meta, f)
+    return store_path
+
+def read_spaxel_store(cube_fullpath, store_path=None):
+    """Memory-map the spaxel-major store of a cube.
+
+    Returns (data, var) arrays of shape (y, x, wave), or None if there is no
+    store or if it does not match the current cube on disk.
+    """
+    if store_path is None: store_path = get_spaxel_store_path(cube_fullpath)
+    meta_fname = os.path.join(store_path, 'meta.json')
+    if not os.path.exists(meta_fname): return None
 
+    with open(meta_fname) as f:
+        meta = json.load(f)
+    fingerprint = _source_fingerprint(cube_fullpath)
+    if any(meta[key] != fingerprint[key] for key in fingerprint):
+        warnings.warn('spaxel store {} is out of date, rerun convert_cube.py'.format(store_path))
+        return None
 
+    data = np.load(os.path.join(store_path, 'data.npy'), mmap_mode='r')
+    var = np.load(os.path.join(store_path, 'var.npy'), mmap_mode='r')
+    return data, var
@@ -1,16 +1,79 @@
 from tkinter import *
 import matplotlib.pyplot as plt
 from matplotlib import rc
+from matplotlib.text import Text
+from matplotlib.cm import ScalarMappable
+from matplotlib.colors import Normalize
+from matplotlib.widgets import RectangleSelector, EllipseSelector, PolygonSelector
+from matplotlib.collections import PolyCollection
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 from matplotlib.backends.backend_tkagg import (
     FigureCanvasTkAgg, NavigationToolbar2Tk)
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from astropy.visualization import ZScaleInterval
 from astropy.io import fits
 import numpy as np 
-from fitviz.model_config import return_models, return_bad_region_masks, return_chi2_window
-
-rc('font',**{'family':'serif','serif':['Computer Modern Roman']})
-rc('text', usetex=True)
+import time
+import warnings
+import threading
+from fitviz.cacheutils import LRUCache, Prefetcher, LatestWorker, get_session_cache
+from fitviz.batchutils import (compute_all_fit_stats, delta_bic, model_display_sum, process_pool,
+                               build_window_index, normalize_bad_regions)
+from fitviz.timingutils import StageTimer, InteractionProfiler
+from fitviz.fitutils import fit_mask, fit_spectra, writable, write_refit, FIT_CHUNK
+from fitviz.qualityutils import compute_fit_quality, QualityIndex
+from fitviz.pyramidutils import SpectralPyramid
+from fitviz.apertureutils import (ApertureIndex, box_mask, ellipse_mask, polygon_mask,
+                                  combine, direct_sum)
+import fitviz.model_config
+
+def set_render_mode(fast_render=False):
+    # text objects keep the mode they were created with, so this has to be
+    # called before the figures are made
+    if fast_render:
+        # mathtext with Computer Modern glyphs, no external LaTeX runs
+        rc('font',**{'family':'serif','serif':['DejaVu Serif']})
+        rc('mathtext', fontset='cm')
+        rc('axes.formatter', use_mathtext=True)
+        rc('text', usetex=False)
+    else:
+        rc('font',**{'family':'serif','serif':['Computer Modern Roman']})
+        rc('text', usetex=True)
+
+set_render_mode()
+
+# keys of Displays.on_key, which matplotlib's default key handler must not
+# also act on (q would close the figure, f toggle fullscreen, p pan)
+APP_KEYS = ['e', 'p', 'a', 'f', 'w', 'n', 'b', 'q', 'm'] + [str(i) for i in range(1, 10)]
+
+def release_app_keys():
+    for name, keys in plt.rcParams.items():
+        if name.startswith('keymap.'):
+            plt.rcParams[name] = [k for k in keys if k not in APP_KEYS]
+
+release_app_keys()
+
+# how often the Tk loop checks for the result of a click, in ms
+POLL_MS = 5
+
+# how much wider than the data the y range of a panel may get before it is
+# rescaled (and the panels drawn in full)
+PANEL_YLIM_SLACK = 0.5
+
+def savefig_latex(fig, fname, **kwargs):
+    # paper-quality output: render all text of the figure through LaTeX,
+    # whatever mode the figure is displayed in
+    texts = fig.findobj(Text)
+    usetex = [t.get_usetex() for t in texts]
+    with plt.rc_context({'text.usetex': True, 'font.family': 'serif',
+                         'font.serif': ['Computer Modern Roman']}):
+        try:
+            for t in texts:
+                t.set_usetex(True)
+            fig.savefig(fname, **kwargs)
+        finally:
+            for t, u in zip(texts, usetex):
+                t.set_usetex(u)
 
 def nice_axis(ax, tick_label_size=12, tick_length=6, tick_minor_length=3):
     ax.tick_params(which='major',labelsize=tick_label_size)
@@ -20,43 +83,305 @@ def nice_axis(ax, tick_label_size=12, tick_length=6, tick_minor_length=3):
     ax.tick_params(axis='y',which='both',right=True)
     ax.tick_params(axis='x',which='both',top=True)
 
+def model_components(model):
+    # model_display returns either one array or a tuple of (total, components...)
+    if isinstance(model, (tuple, list)):
+        return list(model)
+    return [model]
+
+def span_verts(spans):
+    # (nspan, 2) wavelength ranges as the vertices of bands over the full
+    # height of the axes, for a PolyCollection in the x-axis transform;
+    # NaN ranges are left out
+    spans = spans[np.all(np.isfinite(spans), axis=1)]
+    verts = np.empty((len(spans), 4, 2))
+    verts[:, :, 0] = spans[:, [0, 0, 1, 1]]
+    verts[:, :, 1] = [0, 1, 1, 0]
+    return verts
+
+def autoscale_y(ax, arrays, margin=0.05, slack=0.):
+    # same limits as the default autoscaling, without going through relim();
+    # returns True if the limits changed; empty arrays (a panel outside the
+    # cube) are left out. With slack > 0 the limits are kept while they hold
+    # the data and are at most 1 + slack times wider than needed, and new
+    # limits leave half of that room, so similar spectra keep the same axis
+    arrays = [a for a in map(np.asarray, arrays) if a.size]
+    if not arrays:
+        return False
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        lo = min(np.nanmin(a) for a in arrays)
+        hi = max(np.nanmax(a) for a in arrays)
+    if not (np.isfinite(lo) and np.isfinite(hi)):
+        return False
+    if hi == lo:
+        lo, hi = lo - 0.5, hi + 0.5
+    pad = margin*(hi - lo)
+    ylim = (lo - pad, hi + pad)
+    y0, y1 = ax.get_ylim()
+    if (y0, y1) == ylim:
+        return False
+    if slack > 0:
+        span = ylim[1] - ylim[0]
+        if y0 <= ylim[0] and y1 >= ylim[1] and y1 - y0 <= (1 + slack)*span:
+            return False
+        ylim = (ylim[0] - 0.25*slack*span, ylim[1] + 0.25*slack*span)
+    ax.set_ylim(ylim)
+    return True
+
+def map_entry(name, image, vmin=None, vmax=None, label='', cmap='jet'):
+    # a 2D map with its colour limits and colour-mapped RGBA image, so that
+    # it can be swapped in without normalizing it again; missing limits
+    # are taken from zscale
+    image = np.asarray(image, dtype=float)
+    if vmin is None or vmax is None:
+        zmin, zmax = ZScaleInterval().get_limits(image[np.isfinite(image)])
+        if vmin is None: vmin = zmin
+        if vmax is None: vmax = zmax
+    rgba = plt.get_cmap(cmap)(Normalize(vmin, vmax)(image), bytes=True)
+    return {'name': name, 'image': image, 'vmin': vmin, 'vmax': vmax,
+            'label': label, 'cmap': cmap, 'rgba': rgba}
+
+class BlitManager:
+    """Redraw a set of animated artists over a cached figure background.
+
+    Everything that is not animated (frames, titles, x axes, static shading)
+    is rendered once into the background on each full draw; update() then
+    only restores the background and draws the animated artists on top.
+    """
+    def __init__(self, canvas, animated_artists=()):
+        self.canvas = canvas
+        self._bg = None
+        self._artists = []
+        for a in animated_artists:
+            self.add_artist(a)
+        self.cid = canvas.mpl_connect('draw_event', self.on_draw)
+
+    def add_artist(self, art):
+        art.set_animated(True)
+        self._artists.append(art)
+
+    def on_draw(self, event):
+        # savefig draws the figure on a different canvas, or on this one
+        # with the animated artists included
+        if event is not None and (event.canvas is not self.canvas or
+                                  self.canvas.is_saving()):
+            return
+        self._bg = self.canvas.copy_from_bbox(self.canvas.figure.bbox)
+        self._draw_animated()
+
+    def _draw_animated(self):
+        fig = self.canvas.figure
+        for a in sorted(self._artists, key=lambda a: a.get_zorder()):
+            fig.draw_artist(a)
+
+    @property
+    def background(self):
+        return self._bg
+
+    def restore(self, bg):
+        # show a background saved from an earlier draw of the same layout
+        self._bg = bg
+        self.update()
+
+    def update(self):
+        if self._bg is None:
+            self.canvas.draw()
+            return
+        self.canvas.restore_region(self._bg)
+        self._draw_animated()
+        self.canvas.blit(self.canvas.figure.bbox)
+
 class Cursor:
-    def __init__(self, ax, canvas, data):
+    """Pixel value readout on the 2D map.
+
+    The text is redrawn through the map's BlitManager instead of redrawing
+    the whole canvas, at most refresh_rate times per second; the last mouse
+    position is always shown. With hover=True the crosshair lines follow the
+    mouse the same way.
+    """
+    def __init__(self, ax, canvas, data, blit_manager, refresh_rate=60.,
+                 hover=False, lines=None):
         self.ax = ax
         self.canvas = canvas
         self.data = data
+        self.blit_manager = blit_manager
+        self.min_interval = 1./refresh_rate
+        self.hover = hover
+        self.lines = lines
 
         # text location in axes coords
         self.txt = self.ax.text(0.7, 1.03, '', transform=ax.transAxes)
+        self.blit_manager.add_artist(self.txt)
+
+        self._pending = None
+        self._timer = None
+        self._last_draw = 0.
 
     def mouse_move(self, event):
         if not event.inaxes:
             return
 
-        x, y = event.xdata, event.ydata
+        self._pending = (int(event.xdata), int(event.ydata))
+        wait = self.min_interval - (time.perf_counter() - self._last_draw)
+        if wait <= 0:
+            self._flush()
+        elif self._timer is None:
+            # draw the latest position once the refresh interval has passed
+            self._timer = self.canvas.new_timer(interval=int(wait*1000) + 1)
+            self._timer.single_shot = True
+            self._timer.add_callback(self._flush)
+            self._timer.start()
+
+    def _flush(self):
+        self._timer = None
+        if self._pending is None:
+            return
+        x, y = self._pending
+        self._pending = None
+
         # update the cursor positions
-        self.txt.set_text('x=%d, y=%d, value=%.2f' % (x, y, self.data[int(y), int(x)]))
-        self.canvas.draw()
+        self.txt.set_text('x=%d, y=%d, value=%.2f' % (x, y, self.data[y, x]))
+        if self.hover and self.lines is not None:
+            lx, ly = self.lines
+            lx.set_ydata([y, y])
+            ly.set_xdata([x, x])
+        self.blit_manager.update()
+        self._last_draw = time.perf_counter()
+
+class HeadlessCanvas(FigureCanvasAgg):
+    # stands in for FigureCanvasTkAgg when rendering without Tk
+    def __init__(self, figure, master=None):
+        super().__init__(figure)
+
+    def get_tk_widget(self):
+        return self
+
+    def grid(self, *args, **kwargs):
+        pass
+
+    def pack(self, *args, **kwargs):
+        pass
 
 class Displays():
-    def __init__(self, config_params, data, model_popts, chi2_maps, bic_maps):
+    def __init__(self, config_params, data, model_popts, chi2_maps, bic_maps,
+                 model_config=None, headless=False):
+        # model_config is any object with the functions of a model config
+        # file, by default the model_config.py copied in by main.py;
+        # headless=True renders to Agg canvases and needs no Tk window
         self.config_params = config_params
+        set_render_mode(config_params.fast_render)
         self.data = data
         self.datacube = data.datacube
-        self.errcube = np.sqrt(data.varcube)*config_params.rescale_noise
+        self.errcube = data.errcube
         self.wave = data.wave
-        self.models = return_models()
-        self.bad_region_masks = return_bad_region_masks()
-        self.chi2_window = return_chi2_window()
+        if model_config is None: model_config = fitviz.model_config
+        self.model_config = model_config
+        self.models = model_config.return_models()
+        self.bad_region_masks = model_config.return_bad_region_masks()
+        self.chi2_window = self._get_chi2_window()
+        # (npanels, nbad, 2) and (ny, nx, npanels, nwindow, 2), NaN-padded
+        self.bad_regions = normalize_bad_regions(self.bad_region_masks,
+                                                 config_params.npanels)
+        self.window_index = self._get_window_index()
         self.model_popts = model_popts
         self.chi2_maps = chi2_maps
         self.bic_maps = bic_maps
         self.linestyles = ['solid', 'dashed', 'dashed', 'dashed', 'dashed', 'dashed']
         self.colors = ['tab:red', 'tab:green', 'tab:orange', 'tab:blue', 'tab:purple', 'tab:brown']
+        self.canvas_class = HeadlessCanvas if headless else FigureCanvasTkAgg
+        self.frame1 = self.frame2 = None
+        self.status_var = None
+        self.map_var = None
+        self.maps = None
+        self.aperture_index = None
+        self.aperture_mode = None
+        # (mask, outline, box) of the region shown, None for a single spaxel
+        self.aperture = None
+        self.refit_panels = set()
+        # ranked fit-quality maps, the one stepped through and the position in it
+        self.quality = None
+        self._quality_thread = None
+        # bumped whenever the fits change, to drop indexes of older fits
+        self.fit_version = 0
+        self.quality_name = 0
+        self.quality_rank = -1
+        self._set_wave_ranges()
+
+        # per-stage timings of each click, and cProfile captures on demand
+        self.timer = StageTimer(config_params.timing_log)
+        self.profiler = InteractionProfiler()
+
+        # prepared per-spaxel data, filled on click and by the prefetcher
+        self.payload_cache = LRUCache(config_params.payload_cache_mb*2**20)
+        self.prefetcher = None
+        if config_params.prefetch:
+            self.prefetcher = Prefetcher(lambda key: self._compute_payload(*key),
+                                         self.payload_cache)
+        # set up with the Tk window, clicks are handled in place without it
+        self.click_worker = None
+        self._polling = False
+
+    def _window_sources(self):
+        # the chi2 windows come from model_config, so cached copies are tied
+        # to model_config.py and to the files its optional
+        # return_chi2_window_files() lists; without that list nothing is cached
+        session_cache = get_session_cache(self.config_params)
+        list_files = getattr(self.model_config, 'return_chi2_window_files', None)
+        if session_cache is None or list_files is None:
+            return None, None
+        return session_cache, [self.model_config.__file__] + list(list_files())
+
+    def _get_chi2_window(self):
+        # one cube shared by all panels, one cube (or None) per panel, or
+        # None, memory-mapped from the session cache when it can be
+        session_cache, sources = self._window_sources()
+        if session_cache is None:
+            return self.model_config.return_chi2_window()
+        loaded = []
+        def load():
+            if not loaded: loaded.append(self.model_config.return_chi2_window())
+            return loaded[0]
+        def layout():
+            # [-2] for None, [-1] for a shared cube, else 1 or 0 per panel
+            w = load()
+            if w is None: return np.array([-2])
+            if isinstance(w, np.ndarray) and w.ndim == 3: return np.array([-1])
+            return np.array([w_i is not None for w_i in w], dtype=int)
+
+        flags = session_cache.get('chi2_window_layout', sources, layout)
+        if flags[0] == -2:
+            return None
+        if flags[0] == -1:
+            return session_cache.get('chi2_window', sources, load)
+        return [session_cache.get('chi2_window_{}'.format(i), sources, lambda i=i: load()[i])
+                if flag else None for i, flag in enumerate(flags)]
+
+    def _get_window_index(self):
+        shape = self.datacube.shape[1:]
+        npanels = self.config_params.npanels
+        compute = lambda: build_window_index(self.chi2_window, npanels, shape)
+        session_cache, sources = self._window_sources()
+        if session_cache is None or self.chi2_window is None:
+            return compute()
+        return session_cache.get('window_index', sources, compute,
+                                 extra='{} {}'.format(npanels, shape))
+
+    def _set_wave_ranges(self):
+        self.wmin, self.wmax = self.config_params.wmin, self.config_params.wmax
+        self.mask_full = (self.wave>self.wmin) & (self.wave<self.wmax)
+        self.wave_full = self.wave[self.mask_full]
+        self.npanels = self.config_params.npanels
+        self.wmins, self.wmaxs = self.config_params.wmins, self.config_params.wmaxs
+        self.panel_masks = []
+        for ipanel in range(self.npanels):
+            self.panel_masks.append((self.wave > self.wmins[ipanel]) & (self.wave < self.wmaxs[ipanel]))
+        self._get_xmodel_range()
 
     def set_full_window(self):
         self.root = Tk()
         self.root.title('fitviz')
+        self.click_worker = LatestWorker(self._compute_request, self.payload_cache)
 
         self.frame1 = Frame(self.root)
         # self.frame2 = LabelFrame(self.root, text='Test', font=('calibre',12,'normal'),
@@ -85,136 +410,703 @@ class Displays():
         self.frame2.columnconfigure(3, weight=1)
 
 
+        self.timer.start('startup')
+
         # display the full 2d image
-        self.show_2d_image()
+        with self.timer.stage('show_2d_image'):
+            self.show_2d_image()
 
         # display the buttons
         self.show_resize_buttons()
+        self.show_map_selector()
 
         # display the full spec
-        self.show_full_spec()
+        with self.timer.stage('show_full_spec'):
+            self.show_full_spec()
 
         # display zoom in windows
-        self.show_zoomin_spec()
+        with self.timer.stage('show_zoomin_spec'):
+            self.show_zoomin_spec()
 
         # display models in windows
-        self.show_models()
+        with self.timer.stage('show_models'):
+            self.show_models()
+
+        # display the timings of the last click
+        self.show_status_bar()
+        self.set_status(self.timer.finish())
+
+        if self.config_params.quality_index:
+            self.start_quality_index()
+
+    def show_figures(self):
+        # all figures without the Tk window around them, for headless use
+        self.timer.start('startup')
+        with self.timer.stage('show_2d_image'):
+            self.show_2d_image()
+        with self.timer.stage('show_full_spec'):
+            self.show_full_spec()
+        with self.timer.stage('show_zoomin_spec'):
+            self.show_zoomin_spec()
+        with self.timer.stage('show_models'):
+            self.show_models()
+        self.timer.finish()
+
+    def show_status_bar(self):
+        self.status_var = StringVar()
+        status_label = Label(self.frame2, textvariable=self.status_var, anchor='w',
+                             font=('calibre',10,'normal'))
+        status_label.pack(side=BOTTOM, fill=X, padx=10)
+
+    def set_status(self, text):
+        if self.status_var is not None:
+            self.status_var.set(text)
 
     def zoom_2Dwindow(self, coord_var):
         coords = coord_var.get()
         coords = [int(i) for i in coords.split(',')]
         self.ax1.set_xlim(coords[0], coords[1])
         self.ax1.set_ylim(coords[2], coords[3])
+        self._clear_map_backgrounds()
         # self.ax1.get_xaxis().set_visible(False)
         # self.ax1.axes.get_yaxis().set_visible(False)
         self.canvas1.draw()
         self.canvas1.get_tk_widget().grid(row=0, columnspan=4, sticky = NSEW)
 
     def onclick_cube(self, event):
-        ynew, xnew = int(event.ydata), int(event.xdata)
-
-        self.lx.set_ydata(ynew)
-        self.ly.set_xdata(xnew)
-        self.ax1.set_title('x={}, y={}'.format(xnew, ynew), fontsize=12)
-
-        self.ax2.clear()
-        mask = (self.wave>self.wmin) & (self.wave<self.wmax)
-        self.ax2.step(self.wave[mask], self.datacube[:, ynew, xnew][mask], 
-                            where='mid',color='k', linewidth=0.5)
-        self.ax2.hlines(0, self.wave[mask][0], self.wave[mask][-1], linestyle='dashed', color='gray')
-        self.ax2.set_xlabel(r'Observed wavelength ($\mathrm{\AA}$)', fontsize=12)
-        self.ax2.set_ylabel(r'$F_\lambda$', fontsize=12)
-        self.canvas2.draw()
-        self.canvas2.get_tk_widget().grid(row=2, columnspan=4, sticky = NSEW)
-
-        spec_pix = self.datacube[:, ynew, xnew]
-        specerr_pix = self.errcube[:, ynew, xnew]
-
+        # clicks go to the region selectors in aperture mode
+        if not event.inaxes or self.aperture_mode is not None:
+            return
+        self.show_spaxel(int(event.ydata), int(event.xdata))
+
+    def show_spaxel(self, ynew, xnew, title=None):
+        # the crosshair moves at once; with a Tk window the spectra are read
+        # and the models evaluated on a worker thread, and only the spaxel
+        # clicked last is painted. cProfile only sees the main thread, so
+        # clicks being profiled are handled here.
+        worker = self.click_worker
+        self.timer.start('x={}, y={}'.format(xnew, ynew),
+                         threads=[worker.ident] if worker is not None else [])
+        self.ycur, self.xcur = ynew, xnew
+        self.aperture = None
+
+        with self.timer.stage('crosshair'):
+            self.lx.set_ydata([ynew, ynew])
+            self.ly.set_xdata([xnew, xnew])
+            self.aperture_outline.set_data([], [])
+            if title is None: title = 'x={}, y={}'.format(xnew, ynew)
+            self.ax1.set_title(title, fontsize=12)
+            self.bm1.update()
+
+        if worker is None or self.profiler.active:
+            if worker is not None: worker.cancel()
+            self.paint_spaxel(ynew, xnew, self.get_payload(ynew, xnew))
+            return
+        worker.request((ynew, xnew))
+        if not self._polling:
+            self._polling = True
+            self.root.after(POLL_MS, self._poll_click)
+
+    def _poll_click(self):
+        # stop polling once there is nothing left to wait for, e.g. after
+        # the worker was cancelled; clicks only come from this thread, so
+        # nothing can be requested between the two checks
+        busy = self.click_worker.busy
+        done = self.click_worker.poll()
+        if done is None:
+            if busy:
+                self.root.after(POLL_MS, self._poll_click)
+            else:
+                self._polling = False
+            return
+        self._polling = False
+        key, payload, error = done
+        if error is not None:
+            raise error
+        if len(key) == 2:
+            self.paint_spaxel(*key, payload)
+        else:
+            self.paint_aperture(payload)
+
+    def paint_spaxel(self, ynew, xnew, payload):
+        self.update_full_spec(payload)
+        self.update_panels(payload)
+
+        if self.prefetcher is not None:
+            self.prefetcher.request(self._get_neighbors(ynew, xnew))
+
+        status = self.timer.finish()
+        if self.data.tile_cache is not None:
+            status += ' | ' + self.data.cache_stats()
+        prof_fname = self.profiler.tick()
+        if prof_fname is not None:
+            status += ' | profile written to {}'.format(prof_fname)
+        self.set_status(status)
+
+    def _get_neighbors(self, y, x):
+        ny, nx = self.datacube.shape[1:]
+        return [(y + dy, x + dx) for dy in [-1, 0, 1] for dx in [-1, 0, 1]
+                if (dy or dx) and 0 <= y + dy < ny and 0 <= x + dx < nx]
+
+    def _compute_request(self, key):
+        # key of a click_worker request: (y, x) of a spaxel, or
+        # (mask, outline, box) of an aperture
+        if len(key) == 2:
+            return self.get_payload(*key)
+        return self._compute_aperture_payload(key[0], key[2])
+
+    def get_payload(self, y, x):
+        with self.timer.stage('cache'):
+            payload = self.payload_cache.get((y, x))
+        if payload is None:
+            generation = self.payload_cache.generation
+            payload = self._compute_payload(y, x)
+            self.payload_cache.put((y, x), payload, generation=generation)
+        return payload
+
+    def _compute_payload(self, y, x):
+        # everything the panels show for one spaxel, ready to be painted
+        # (the timer ignores calls from the prefetcher thread)
+        with self.timer.stage('cube_slice'):
+            spec_pix = np.asarray(self.datacube[:, y, x])
+        with self.timer.stage('error'):
+            specerr_pix = np.asarray(self.errcube[:, y, x])
+        payload = self._spectrum_payload(spec_pix, specerr_pix)
+        payload['windows'] = self.window_index[y, x]
         for ipanel in range(self.npanels):
-            mask = (self.wave > self.wmins[ipanel]) & (self.wave < self.wmaxs[ipanel])
-            model = self.models[ipanel](self.xmodels[ipanel], 
-                                        *self.model_popts[ipanel][:, ynew, xnew])
-            self.axes[ipanel].clear()
-            self.axes[ipanel].step(self.wave[mask], spec_pix[mask], where='mid', color='k')
-            self.axes[ipanel].step(self.wave[mask], specerr_pix[mask], where='mid', color='b')
-            nmodels = len(model)
-            try:
-                for i in range(nmodels):
-                    self.axes[ipanel].plot(self.xmodels[ipanel], model[i], 
-                                           linestyle=self.linestyles[i], 
-                                           c=self.colors[i])
-            except: self.axes[ipanel].plot(self.xmodels[ipanel], model, 
-                                           linestyle=self.linestyles[0], 
-                                           c=self.colors[0])
-
-            if len(self.bad_region_masks) > 0:
-                bad_regions = self.bad_region_masks[ipanel]
-                for ibad in range(int(len(bad_regions)/2)):
-                    self.axes[ipanel].axvspan(bad_regions[ibad*2], bad_regions[ibad*2+1], alpha=0.3, color='gray')
-
-            if self.chi2_window is not None:
-                try:
-                    nwindow = int(self.chi2_window.shape[0]/2)
-                    for iwindow in range(nwindow):
-                        self.axes[ipanel].axvspan(self.chi2_window[iwindow*2, ynew, xnew], 
-                            self.chi2_window[iwindow*2+1, ynew, xnew], alpha=0.2, color='tab:green')
-                except:
-                    chi2_window_ipanel = self.chi2_window[ipanel]
-                    for iwindow in range(int(chi2_window_ipanel.shape[0]/2)):
-                        self.axes[ipanel].axvspan(chi2_window_ipanel[iwindow*2, ynew, xnew], 
-                            chi2_window_ipanel[iwindow*2+1, ynew, xnew], alpha=0.2, color='tab:green')
-
+            with self.timer.stage('models'):
+                payload['models'].append(model_components(self.models[ipanel](self.xmodels[ipanel],
+                                            *self.model_popts[ipanel][:, y, x])))
             if self.chi2_maps is not None:
-                self.axes[ipanel].text(0.1, 0.9, 
-                    r'$\chi^2_\nu=${:.2f}'.format(self.chi2_maps[ipanel][ynew, xnew]), 
-                    transform=self.axes[ipanel].transAxes)  
-
-            # if self.bic_maps is not None:
-            #     self.axes[ipanel].text(0.1, 0.8, 
-            #         r'BIC={}'.format(self.bic_maps[ipanel][ynew, xnew]), 
-            #         transform=self.axes[ipanel].transAxes)   
-            
-            self.axes[ipanel].set_xlim(self.wmins[ipanel], self.wmaxs[ipanel])
-            self.axes[ipanel].set_ylabel(r'$F_\lambda$', fontsize=12)
-            self.axes[ipanel].set_title(self.config_params.panel_titles[ipanel], fontsize=13)
-
-        self.axes[-1].set_xlabel(r'Observed wavelength ($\mathrm{\AA}$)', fontsize=12)
-        self.canvas3.draw()
-        self.canvas3.get_tk_widget().pack(fill = BOTH, expand = True, padx = 10, pady=2)
+                payload['chi2'].append(self.chi2_maps[ipanel][y, x])
+        return payload
+
+    def _spectrum_payload(self, spec_pix, specerr_pix):
+        # the parts of a payload that only depend on the spectrum and errors
+        with self.timer.stage('pyramid'):
+            full = SpectralPyramid(self.wave_full, spec_pix[self.mask_full])
+        return {'full': full,
+                'spec': [spec_pix[mask] for mask in self.panel_masks],
+                'err': [specerr_pix[mask] for mask in self.panel_masks],
+                'models': [], 'windows': [], 'chi2': []}
+
+    def get_aperture_index(self):
+        # built on first use (on the click worker), over the channels shown
+        # in the panels; None if its tables would take more than
+        # aperture_max_mb, and the panels are then summed from the cube
+        if self.aperture_index is None:
+            channels = np.flatnonzero(np.any(self.panel_masks, axis=0))
+            nbytes = ApertureIndex.table_nbytes(len(channels), self.datacube.shape[1:])
+            if nbytes > self.config_params.aperture_max_mb*2**20:
+                self.aperture_index = False
+            else:
+                with self.timer.stage('aperture_index'):
+                    self.aperture_index = ApertureIndex(self.datacube, self.data.varcube, channels)
+        return self.aperture_index or None
+
+    def _compute_aperture_payload(self, mask, box=None):
+        # mean or summed spectrum of the spaxels in mask, with its errors
+        # from the summed variance; box = (y0, y1, x0, x1) if mask is one.
+        # Channels of the full spectrum outside the panels are summed from
+        # the cube.
+        index = self.get_aperture_index()
+        stat = self.config_params.aperture_stat
+        spec_pix = np.full(len(self.wave), np.nan)
+        specerr_pix = np.full(len(self.wave), np.nan)
+        parts = []
+        if index is not None:
+            with self.timer.stage('aperture'):
+                sums = index.box_sum(*box) if box is not None else index.mask_sum(mask)
+            parts.append((index.channels, sums))
+            direct = self.mask_full & ~np.any(self.panel_masks, axis=0)
+        else:
+            direct = self.mask_full | np.any(self.panel_masks, axis=0)
+        with self.timer.stage('aperture_cube'):
+            channels = np.flatnonzero(direct)
+            parts.append((channels, direct_sum(self.datacube, self.data.varcube, channels, mask)))
+        for channels, sums in parts:
+            flux, var = combine(*sums, stat=stat)
+            spec_pix[channels] = flux
+            specerr_pix[channels] = np.sqrt(var)*self.errcube.rescale_noise
+        payload = self._spectrum_payload(spec_pix, specerr_pix)
+
+        # models of the spaxels added up the same way; chi2 windows of the
+        # spaxel closest to the centre
+        ys, xs = np.nonzero(mask)
+        icen = np.argmin((ys - ys.mean())**2 + (xs - xs.mean())**2)
+        payload['windows'] = self.window_index[ys[icen], xs[icen]]
+        for ipanel in range(self.npanels):
+            with self.timer.stage('models'):
+                payload['models'].append(self._aperture_model(ipanel, ys, xs, stat))
+            payload['chi2'].append(np.nan)
+        return payload
+
+    def _aperture_model(self, ipanel, ys, xs, stat):
+        ncomp = len(self.model_lines[ipanel])
+        nan_model = [np.full(len(self.xmodels[ipanel]), np.nan)]*ncomp
+        if len(ys) > self.config_params.aperture_max_models:
+            return nan_model
+        popts = np.asarray(self.model_popts[ipanel][:, ys, xs], dtype=float)
+        popts = popts[:, np.all(np.isfinite(popts), axis=0)]
+        if popts.shape[1] == 0:
+            return nan_model
+        total = model_components(model_display_sum(self.models[ipanel], self.xmodels[ipanel], popts))
+        return [t/popts.shape[1] for t in total] if stat == 'mean' else total
+
+    def show_aperture(self, mask, outline, box=None):
+        # outline is the (x, y) vertices of the region, drawn on the map;
+        # the spectra are summed on the click worker, as for a spaxel, and
+        # so is the aperture index the first time
+        nspax = int(mask.sum())
+        if nspax == 0:
+            return
+        worker = self.click_worker
+        self.aperture = (mask, outline, box)
+        self.timer.start('aperture of {} spaxels'.format(nspax),
+                         threads=[worker.ident] if worker is not None else [])
+        with self.timer.stage('crosshair'):
+            self.aperture_outline.set_data(*outline)
+            self.ax1.set_title('{} of {} spaxels'.format(self.config_params.aperture_stat, nspax),
+                               fontsize=12)
+            self.bm1.update()
+
+        if worker is None or self.profiler.active:
+            if worker is not None: worker.cancel()
+            self.paint_aperture(self._compute_aperture_payload(mask, box))
+            return
+        if self.aperture_index is None:
+            self.set_status('building the aperture index...')
+        worker.request(self.aperture)
+        if not self._polling:
+            self._polling = True
+            self.root.after(POLL_MS, self._poll_click)
+
+    def paint_aperture(self, payload):
+        self.update_full_spec(payload)
+        self.update_panels(payload)
+        status = self.timer.finish()
+        if self.aperture_index is False:
+            status += ' | aperture index over aperture_max_mb, summed from the cube'
+        elif self.aperture_index is not None:
+            status += ' | aperture index {:.0f} MB'.format(self.aperture_index.nbytes/2**20)
+        self.set_status(status)
+
+    def on_box_select(self, eclick, erelease):
+        x0, x1 = sorted([eclick.xdata, erelease.xdata])
+        y0, y1 = sorted([eclick.ydata, erelease.ydata])
+        mask = box_mask(self.data.init_map.shape, x0, x1, y0, y1)
+        ys, xs = np.nonzero(mask)
+        if len(ys) == 0:
+            return
+        box = (ys.min(), ys.max() + 1, xs.min(), xs.max() + 1)
+        self.show_aperture(mask, ([x0, x1, x1, x0, x0], [y0, y0, y1, y1, y0]), box)
+
+    def on_ellipse_select(self, eclick, erelease):
+        x0, x1 = sorted([eclick.xdata, erelease.xdata])
+        y0, y1 = sorted([eclick.ydata, erelease.ydata])
+        t = np.linspace(0, 2*np.pi, 65)
+        outline = (0.5*(x0 + x1) + 0.5*(x1 - x0)*np.cos(t), 0.5*(y0 + y1) + 0.5*(y1 - y0)*np.sin(t))
+        self.show_aperture(ellipse_mask(self.data.init_map.shape, x0, x1, y0, y1), outline)
+
+    def on_polygon_select(self, verts):
+        x, y = zip(*(list(verts) + [verts[0]]))
+        self.show_aperture(polygon_mask(self.data.init_map.shape, verts), (x, y))
+
+    def cycle_aperture_mode(self):
+        # single spaxels -> box -> ellipse -> polygon -> single spaxels
+        modes = [None, 'box', 'ellipse', 'polygon']
+        self.aperture_mode = modes[(modes.index(self.aperture_mode) + 1) % len(modes)]
+        for mode, selector in self.selectors.items():
+            selector.set_active(mode == self.aperture_mode)
+        self.set_status('click on spaxels' if self.aperture_mode is None else
+                        'drag a {} on the map'.format(self.aperture_mode))
+
+    def set_rescale_noise(self, rescale_noise):
+        self.errcube.rescale_noise = rescale_noise
+        self.payload_cache.clear()
+
+    def update_full_spec(self, payload):
+        self.full_pyramid = payload['full']
+        with self.timer.stage('full_spec'):
+            self._set_full_envelope()
+        with self.timer.stage('full_draw'):
+            self.bm2.update()
+
+    def _set_full_envelope(self):
+        # draw one min/max bin per screen pixel of ax2, or the channels
+        # themselves when there are fewer of them than pixels
+        x0, x1 = self.ax2.get_xlim()
+        npix = max(int(self.ax2.bbox.width), 1)
+        x, y, decimated = self.full_pyramid.envelope(x0, x1, npix)
+        self.line_full.set_data(x, y)
+        self.line_full.set_drawstyle('default' if decimated else 'steps-mid')
+        autoscale_y(self.ax2, [y, [0]])
+
+    def _on_full_view_change(self, *args):
+        # zoom, pan or resize: the x axis changes too, so redraw everything
+        self._set_full_envelope()
+        self.canvas2.draw_idle()
+
+    def update_panels(self, payload, draw=True):
+        # draw=False only updates the artists, e.g. before a savefig. The y
+        # axes are part of the background, so the figure is only drawn in
+        # full when the limits of a panel change, and blitted otherwise
+        rescaled = False
+        for ipanel in range(self.npanels):
+            spec, specerr = payload['spec'][ipanel], payload['err'][ipanel]
+            model = payload['models'][ipanel]
+            with self.timer.stage('lines'):
+                self.spec_lines[ipanel].set_ydata(spec)
+                self.err_lines[ipanel].set_ydata(specerr)
+                for line, component in zip(self.model_lines[ipanel], model):
+                    line.set_ydata(component)
+                rescaled |= autoscale_y(self.axes[ipanel], [spec, specerr] + model,
+                                        slack=PANEL_YLIM_SLACK)
+
+            with self.timer.stage('spans'):
+                self.window_collections[ipanel].set_verts(span_verts(payload['windows'][ipanel]))
+
+            with self.timer.stage('text'):
+                # payloads have no chi2 until there are chi2 maps, e.g. from a refit
+                chi2 = payload['chi2'][ipanel] if payload['chi2'] else np.nan
+                self.chi2_texts[ipanel].set_text(
+                    r'$\chi^2_\nu=${:.2f}'.format(chi2) if np.isfinite(chi2) else '')
+
+        if draw:
+            with self.timer.stage('panel_draw'):
+                if rescaled:
+                    self.canvas3.draw()
+                else:
+                    self.bm3.update()
+
+    def recompute_stats(self, nproc=None):
+        """Recompute the chi2 and BIC maps of all panels from the cube.
+
+        Uses the current rescale_noise, bad regions and chi2 windows, so the
+        values shown in the panels match them.
+        """
+        self.chi2_maps, self.bic_maps = compute_all_fit_stats(self.models, self.model_popts,
+                                            self.data, self.chi2_window, self.bad_region_masks,
+                                            self.config_params, nproc=nproc)
+        self.payload_cache.clear()
+        self.quality = None
+        self.fit_version += 1
+        if self.maps is not None:
+            self._build_maps()
+            self.select_map(self.imap)
+
+    def refit(self, nproc=None):
+        """Fit all panels again at the current spaxel, or in the region shown.
+
+        Each fit starts from the current parameters and only uses the
+        channels of the chi2 windows; regions are fitted on nproc
+        processes. The parameters, chi2 and BIC are updated in memory
+        (save_refit writes them out) and the spectra are drawn again.
+        """
+        if self.aperture is not None:
+            ys, xs = np.nonzero(self.aperture[0])
+        else:
+            ys, xs = np.array([self.ycur]), np.array([self.xcur])
+        self.timer.start('refit of {} spaxels'.format(len(ys)))
+        # one pool for all panels, as starting its processes takes a while
+        executor = None
+        if len(ys) > FIT_CHUNK:
+            with self.timer.stage('pool'):
+                executor = process_pool(nproc)
+        try:
+            for ipanel in range(self.npanels):
+                with self.timer.stage('panel {}'.format(ipanel + 1)):
+                    self._refit_panel(ipanel, ys, xs, executor)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        self.payload_cache.clear()
+        self.quality = None
+        self.fit_version += 1
+        if self.maps is not None:
+            imap = self.imap
+            self._build_maps()
+            self.select_map(imap)
+        status = self.timer.finish()
+
+        if self.aperture is not None:
+            self.show_aperture(*self.aperture)
+        else:
+            self.show_spaxel(self.ycur, self.xcur)
+        self.set_status(status)
+
+    def _refit_panel(self, ipanel, ys, xs, executor=None):
+        # read the channels spanned by the windows of all spaxels at once
+        wrange = (self.wmins[ipanel], self.wmaxs[ipanel])
+        windows = self.window_index[ys, xs, ipanel]
+        lo = np.nanmin(np.append(windows[..., 0], wrange[0]))
+        hi = np.nanmax(np.append(windows[..., 1], wrange[1]))
+        sel = slice(np.searchsorted(self.wave, lo), np.searchsorted(self.wave, hi, side='right'))
+        wave = self.wave[sel]
+        y0, y1, x0, x1 = ys.min(), ys.max() + 1, xs.min(), xs.max() + 1
+        specs = np.asarray(self.data.datacube[sel, y0:y1, x0:x1], dtype=float)[:, ys - y0, xs - x0].T
+        var = np.asarray(self.data.varcube[sel, y0:y1, x0:x1], dtype=float)[:, ys - y0, xs - x0].T
+        errs = np.sqrt(var)*self.errcube.rescale_noise
+        masks = np.array([fit_mask(wave, w, wrange, self.bad_regions[ipanel]) for w in windows])
+
+        popts = writable(self.model_popts[ipanel])
+        new_popts, chi2, bic = fit_spectra(self.models[ipanel], wave, specs, errs, masks,
+                                           popts[:, ys, xs].T, executor=executor)
+        ok = np.all(np.isfinite(new_popts), axis=1)
+        popts[:, ys[ok], xs[ok]] = new_popts[ok].T
+        self.model_popts[ipanel] = popts
+
+        shape = self.datacube.shape[1:]
+        if self.chi2_maps is None:
+            self.chi2_maps = [np.full(shape, np.nan) for i in range(self.npanels)]
+        if self.bic_maps is None:
+            self.bic_maps = [np.full(shape, np.nan) for i in range(self.npanels)]
+        for maps, values in [(self.chi2_maps, chi2), (self.bic_maps, bic)]:
+            maps[ipanel] = writable(maps[ipanel])
+            maps[ipanel][ys[ok], xs[ok]] = values[ok]
+        self.refit_panels.add(ipanel)
+
+    def save_refit(self):
+        # write the parameters, chi2 and BIC of the refitted panels next to
+        # the files they were read from, as *_refit.fits
+        cp = self.config_params
+        fnames = []
+        for ipanel in sorted(self.refit_panels):
+            model_fname = cp.model_path[ipanel] + cp.model_fname[ipanel]
+            fnames.append(write_refit(model_fname, self.model_popts[ipanel], model_fname))
+            for kind, maps in [('chi2', self.chi2_maps), ('bic', self.bic_maps)]:
+                # maps without a file of their own go next to the parameters
+                paths = getattr(cp, kind + '_path')
+                fname = model_fname.replace('.fits', '_' + kind + '.fits')
+                if paths is not None:
+                    fname = paths[ipanel] + getattr(cp, kind + '_fname')[ipanel]
+                fnames.append(write_refit(fname, maps[ipanel], fname))
+        self.set_status('wrote ' + ', '.join(fnames) if fnames else 'nothing refitted yet')
+        return fnames
+
+    def start_quality_index(self):
+        # compute the fit-quality index on a background thread; it has a
+        # timer of its own, as the clicks meanwhile are timed on self.timer
+        def run():
+            timer = StageTimer(self.config_params.timing_log)
+            timer.start('fit-quality index (background)')
+            self.get_quality_index(timer=timer)
+            timer.finish()
+        self._quality_thread = threading.Thread(target=run, daemon=True)
+        self._quality_thread.start()
+
+    def get_quality_index(self, nproc=None, timer=None):
+        """The QualityIndex of the current fits, computed on first use."""
+        if timer is None: timer = self.timer
+        quality = self.quality
+        if quality is not None:
+            return quality
+        with timer.stage('quality_index'):
+            thread = self._quality_thread
+            if thread is not None and thread.is_alive() and thread is not threading.current_thread():
+                thread.join()
+            quality = self.quality
+            if quality is None:
+                version = self.fit_version
+                maps = compute_fit_quality(self.models, self.model_popts, self.data, self.chi2_window,
+                                           self.bad_region_masks, self.config_params, nproc=nproc)
+                quality = QualityIndex(maps, top=self.config_params.quality_top)
+                # a refit while computing makes this index stale: use it for
+                # this call only
+                if version == self.fit_version:
+                    self.quality = quality
+        return quality
+
+    def _timed_quality_index(self):
+        # the index for a key press, timed as an interaction of its own when
+        # it has to be computed or waited for; returns it and the timing
+        if self.quality is not None:
+            return self.quality, None
+        self.timer.start('fit-quality index')
+        quality = self.get_quality_index()
+        return quality, self.timer.finish()
+
+    def step_quality(self, step):
+        # go to the next (step=1) or previous (step=-1) worst spaxel of the
+        # current fit-quality map
+        quality, _ = self._timed_quality_index()
+        name = quality.names[self.quality_name]
+        if quality.count(name) == 0:
+            self.set_status('no spaxels with a finite {}'.format(name))
+            return
+        self.quality_rank = int(np.clip(self.quality_rank + step, 0, quality.count(name) - 1))
+        y, x, value = quality.spaxel(name, self.quality_rank)
+        self.show_spaxel(y, x, title='x={}, y={}: {} #{} = {:.3g}'.format(
+                         x, y, name, self.quality_rank + 1, value))
+
+    def cycle_quality(self):
+        quality, timing = self._timed_quality_index()
+        self.quality_name = (self.quality_name + 1) % len(quality)
+        self.quality_rank = -1
+        name = quality.names[self.quality_name]
+        status = 'worst spaxels by {} ({} ranked): n for next, b for previous'.format(
+                 name, quality.count(name))
+        self.set_status(status if timing is None else status + ' | ' + timing)
+
+    def _build_maps(self):
+        # the main map of the data config first, then its extra maps
+        cp = self.config_params
+        self.maps = [map_entry(cp.map_fname, self.data.init_map, cp.vmin, cp.vmax,
+                               cp.color_bar_label)]
+        for name, vmin, vmax, label in cp.extra_maps:
+            vmin = None if vmin == 'auto' else float(vmin)
+            vmax = None if vmax == 'auto' else float(vmax)
+            self.maps.append(map_entry(name, self._get_map_image(name), vmin, vmax, label))
+        self.imap = 0
+
+    def _get_map_image(self, name):
+        # a file in map_path, chi2:<ipanel>, bic:<ipanel> or dbic:<ipanel>,<jpanel>
+        if ':' not in name:
+            return self.data.maps[name]
+        kind, arg = name.split(':')
+        if kind not in ['chi2', 'bic', 'dbic']:
+            raise ValueError('unknown map {}'.format(name))
+        maps = self.chi2_maps if kind == 'chi2' else self.bic_maps
+        if maps is None:
+            raise ValueError('map {} needs {}_path in the data config'.format(
+                             name, 'chi2' if kind == 'chi2' else 'bic'))
+        if kind == 'dbic':
+            ipanel, jpanel = [int(i) for i in arg.split(',')]
+            return delta_bic(maps, ipanel, jpanel)
+        return maps[int(arg)]
+
+    def select_map(self, imap):
+        # swap in one of the preloaded maps
+        if not 0 <= imap < len(self.maps):
+            return
+        self.imap = imap
+        if self.map_var is not None:
+            self.map_var.set(self._map_option(imap))
+        self._show_map_entry(self.maps[imap], self._map_backgrounds.get(imap))
+
+    def show_map(self, image, vmin=None, vmax=None, color_bar_label=None):
+        # replace the 2D image, e.g. by a chi2 or delta BIC map
+        if color_bar_label is None: color_bar_label = self.cb.ax.get_ylabel()
+        self.imap = None
+        self._show_map_entry(map_entry('', image, vmin, vmax, color_bar_label))
+
+    def _show_map_entry(self, m, bg=None):
+        # the image is already RGBA; the colour bar has its own mappable.
+        # With the background of an earlier draw of this map, only the
+        # animated artists are drawn
+        self.im1.set_data(m['rgba'])
+        if self.cb_mappable.get_cmap().name != m['cmap']:
+            self.cb_mappable.set_cmap(m['cmap'])
+        self.cb_mappable.set_clim(m['vmin'], m['vmax'])
+        self.cb.set_label(m['label'], fontsize=12)
+        self.cursor.data = m['image']
+        if bg is not None:
+            self.bm1.restore(bg)
+        else:
+            self.canvas1.draw_idle()
+
+    def _on_map_draw(self, event):
+        # runs after bm1.on_draw: keep the background of every map drawn at
+        # the current zoom and window size
+        if self.imap is not None and self.bm1.background is not None:
+            self._map_backgrounds[self.imap] = self.bm1.background
+
+    def _clear_map_backgrounds(self, *args):
+        self._map_backgrounds = {}
 
     def show_2d_image(self):
         init_map = self.data.init_map
-        vmin, vmax = self.config_params.vmin, self.config_params.vmax
-        color_bar_label = self.config_params.color_bar_label
+        self._build_maps()
+        m = self.maps[0]
 
         self.y0 = int(init_map.shape[0]/2)
         self.x0 = int(init_map.shape[1]/2)
+        self.ycur, self.xcur = self.y0, self.x0
 
         self.fig1 = plt.figure(figsize=(5,5))
         self.ax1 = self.fig1.add_subplot(111)
         self.ax1.set_title('x={}, y={}'.format(self.x0, self.y0), fontsize=12)
-        self.im1 = self.ax1.imshow(init_map, cmap = 'jet', vmin = vmin, 
-                                    vmax = vmax, origin='lower')
+        self.im1 = self.ax1.imshow(m['rgba'], origin='lower')
         divider = make_axes_locatable(self.ax1)
         cax = divider.append_axes("right", size="5%", pad=0.05)
-        cb = self.fig1.colorbar(self.im1, cax=cax)
-        cb.set_label(color_bar_label,fontsize=12)
+        self.cb_mappable = ScalarMappable(Normalize(m['vmin'], m['vmax']), m['cmap'])
+        self.cb = self.fig1.colorbar(self.cb_mappable, cax=cax)
+        self.cb.set_label(m['label'],fontsize=12)
 
         # draw dashed cross to show where the pointed pixel is
         self.lx = self.ax1.axhline(color='k', linestyle='dashed')
         self.ly = self.ax1.axvline(color='k', linestyle='dashed')
-        self.lx.set_ydata(self.y0)
-        self.ly.set_xdata(self.x0)
+        self.lx.set_ydata([self.y0, self.y0])
+        self.ly.set_xdata([self.x0, self.x0])
+        self.aperture_outline, = self.ax1.plot([], [], color='k', linewidth=1.5)
 
         # put it into the frame
-        self.canvas1 = FigureCanvasTkAgg(self.fig1, master=self.frame1)  
+        self.canvas1 = self.canvas_class(self.fig1, master=self.frame1)  
+        # the map is only redrawn on zoom, the crosshair, title and cursor
+        # readout are blitted over it
+        self.bm1 = BlitManager(self.canvas1, [self.lx, self.ly, self.aperture_outline,
+                                              self.ax1.title])
+        self._map_backgrounds = {}
+        self.canvas1.mpl_connect('draw_event', self._on_map_draw)
+        self.canvas1.mpl_connect('resize_event', self._clear_map_backgrounds)
+        self.cursor = Cursor(self.ax1, self.canvas1, m['image'], self.bm1,
+                             refresh_rate=self.config_params.refresh_rate,
+                             hover=self.config_params.hover_crosshair,
+                             lines=(self.lx, self.ly))
         self.canvas1.draw()
         self.canvas1.get_tk_widget().grid(row=0, columnspan=4, sticky = NSEW)
 
         # set up interative functions
         self.canvas1.mpl_connect('button_press_event', self.onclick_cube)
-        self.cursor = Cursor(self.ax1, self.canvas1, init_map)
         self.canvas1.mpl_connect('motion_notify_event', self.cursor.mouse_move)
+        self.canvas1.mpl_connect('key_press_event', self.on_key)
+
+        # region selectors for aperture spectra, switched on with 'a'
+        self.selectors = {
+            'box': RectangleSelector(self.ax1, self.on_box_select, useblit=True),
+            'ellipse': EllipseSelector(self.ax1, self.on_ellipse_select, useblit=True),
+            'polygon': PolygonSelector(self.ax1, self.on_polygon_select, useblit=True)}
+        for selector in self.selectors.values():
+            selector.set_active(False)
+
+    def on_key(self, event):
+        if event.key == 'e':
+            self.export_figures()
+        elif event.key == 'p':
+            self.toggle_profile()
+        elif event.key == 'a':
+            self.cycle_aperture_mode()
+        elif event.key == 'f':
+            self.refit()
+        elif event.key == 'w':
+            self.save_refit()
+        elif event.key == 'n':
+            self.step_quality(1)
+        elif event.key == 'b':
+            self.step_quality(-1)
+        elif event.key == 'q':
+            self.cycle_quality()
+        elif event.key == 'm':
+            self.select_map((self.imap + 1) % len(self.maps))
+        elif event.key is not None and event.key.isdigit() and event.key != '0':
+            self.select_map(int(event.key) - 1)
+
+    def toggle_profile(self):
+        # start a cProfile capture of the next profile_clicks clicks, or end
+        # the running one early
+        if self.profiler.active:
+            prof_fname = self.profiler.stop()
+            self.set_status('profile written to {}'.format(prof_fname))
+        else:
+            nclicks = self.config_params.profile_clicks
+            self.profiler.start(nclicks)
+            self.set_status('profiling the next {} clicks'.format(nclicks))
+
+    def export_figures(self, fmt='pdf'):
+        # save the current map, spectrum and panels with LaTeX text
+        prefix = 'fitviz_x{}_y{}'.format(self.xcur, self.ycur)
+        for name, fig in [('map', self.fig1), ('spec', self.fig2), ('panels', self.fig3)]:
+            savefig_latex(fig, '{}_{}.{}'.format(prefix, name, fmt))
 
     def show_resize_buttons(self):
         # find area to display
@@ -237,41 +1129,65 @@ class Displays():
                                     font=('calibre',12,'normal'))
         fullframe_button.grid(row=1, column=3, sticky=NSEW)
 
+    def _map_option(self, imap):
+        return '{}: {}'.format(imap + 1, self.maps[imap]['label'])
+
+    def show_map_selector(self):
+        # maps can also be picked with the number keys, or cycled with 'm'
+        if len(self.maps) < 2:
+            return
+        options = [self._map_option(imap) for imap in range(len(self.maps))]
+        self.map_var = StringVar(value=options[self.imap])
+        map_label = Label(self.frame1, text='Map: ', font=('calibre',12,'normal'))
+        map_menu = OptionMenu(self.frame1, self.map_var, *options,
+                              command=lambda option: self.select_map(options.index(option)))
+        map_label.grid(row=3, column=0, padx = 5, pady=2, sticky = NSEW)
+        map_menu.grid(row=3, column=1, columnspan=3, sticky = NSEW)
+
     def show_full_spec(self):
         init_spec = self.datacube[:, self.y0, self.x0]
-        self.wmin, self.wmax = self.config_params.wmin, self.config_params.wmax
         self.fig2 = plt.figure(figsize=(6,2))
         self.ax2 = self.fig2.add_subplot(111)
-        mask = (self.wave>self.wmin) & (self.wave<self.wmax)
-        self.ax2.step(self.wave[mask], init_spec[mask], where='mid',color='k', linewidth=0.5)
+        mask = self.mask_full
+        self.line_full, = self.ax2.step(self.wave[mask], init_spec[mask], where='mid',color='k', linewidth=0.5)
+        # fix the x range of the full spectrum before decimating it
+        self.ax2.set_xlim(self.ax2.get_xlim())
         self.ax2.set_xlabel(r'Observed wavelength ($\mathrm{\AA}$)', fontsize=12)
         self.ax2.set_ylabel(r'$F_\lambda$', fontsize=12)
-        self.ax2.hlines(0, self.wave[mask][0], self.wave[mask][-1], linestyle='dashed', color='gray')
+        zero_line = self.ax2.hlines(0, self.wave[mask][0], self.wave[mask][-1], linestyle='dashed', color='gray')
         nice_axis(self.ax2)
         self.fig2.tight_layout()
-        self.canvas2 = FigureCanvasTkAgg(self.fig2, master=self.frame1)  # A tk.DrawingArea.
+        self.canvas2 = self.canvas_class(self.fig2, master=self.frame1)  # A tk.DrawingArea.
+        self.full_pyramid = SpectralPyramid(self.wave_full, np.asarray(init_spec[mask]))
+        self._set_full_envelope()
+        self.ax2.callbacks.connect('xlim_changed', self._on_full_view_change)
+        self.canvas2.mpl_connect('resize_event', self._on_full_view_change)
+        # the y axis changes with every spaxel, everything else is static
+        self.bm2 = BlitManager(self.canvas2, [self.ax2.yaxis, zero_line, self.line_full])
         self.canvas2.draw()
         self.canvas2.get_tk_widget().grid(row=2, columnspan=4, sticky = NSEW)
 
     def show_zoomin_spec(self):
-        self.npanels = self.config_params.npanels
-        self.wmins, self.wmaxs = self.config_params.wmins, self.config_params.wmaxs
         spec_pix = self.datacube[:, self.y0, self.x0]
         specerr_pix = self.errcube[:, self.y0, self.x0]
 
-        self.fig3, self.axes = plt.subplots(self.npanels, 1, figsize=(4,2*self.npanels))
+        self.fig3, axes = plt.subplots(self.npanels, 1, figsize=(4,2*self.npanels))
+        self.axes = np.atleast_1d(axes)
+        self.spec_lines = []
+        self.err_lines = []
         for ipanel in range(self.npanels):
-            mask = (self.wave > self.wmins[ipanel]) & (self.wave < self.wmaxs[ipanel])
-            self.axes[ipanel].step(self.wave[mask], spec_pix[mask], where='mid', color='k')
-            self.axes[ipanel].step(self.wave[mask], specerr_pix[mask], where='mid', color='b')
+            mask = self.panel_masks[ipanel]
+            line, = self.axes[ipanel].step(self.wave[mask], spec_pix[mask], where='mid', color='k')
+            self.spec_lines.append(line)
+            line, = self.axes[ipanel].step(self.wave[mask], specerr_pix[mask], where='mid', color='b')
+            self.err_lines.append(line)
             self.axes[ipanel].set_ylabel(r'$F_\lambda$', fontsize=12)
             self.axes[ipanel].set_title(self.config_params.panel_titles[ipanel], fontsize=13)
             self.axes[ipanel].set_xlim(self.wmins[ipanel], self.wmaxs[ipanel])
             nice_axis(self.axes[ipanel])
         self.axes[-1].set_xlabel(r'Observed wavelength ($\mathrm{\AA}$)', fontsize=12)
         self.fig3.tight_layout()
-        self.canvas3 = FigureCanvasTkAgg(self.fig3, master=self.frame2)  
-        self.canvas3.draw()
+        self.canvas3 = self.canvas_class(self.fig3, master=self.frame2)  
         self.canvas3.get_tk_widget().pack(fill = BOTH, expand = True, padx = 10, pady=2)
 
     def _get_xmodel_range(self):
@@ -280,60 +1196,55 @@ class Displays():
             self.xmodels.append(np.arange(self.wmins[ipanel], self.wmaxs[ipanel], 0.1))
 
     def show_models(self):
-        self._get_xmodel_range()
+        # all artists are created here once; onclick_cube only updates them
+        self.model_lines = []
+        self.window_collections = []
+        self.chi2_texts = []
+        self.bm3 = BlitManager(self.canvas3)
         for ipanel in range(self.npanels):
-            model = self.models[ipanel](self.xmodels[ipanel], 
-                                        *self.model_popts[ipanel][:,self.y0, self.x0])
-            nmodels = len(model)
-            try:
-                for i in range(nmodels):
-                    self.axes[ipanel].plot(self.xmodels[ipanel], model[i], 
-                                           linestyle=self.linestyles[i], 
-                                           c=self.colors[i])
-            except: self.axes[ipanel].plot(self.xmodels[ipanel], model, 
-                                           linestyle=self.linestyles[0], 
-                                           c=self.colors[0])
-
-            if len(self.bad_region_masks) > 0:
-                bad_regions = self.bad_region_masks[ipanel]
-                for ibad in range(int(len(bad_regions)/2)):
-                    self.axes[ipanel].axvspan(bad_regions[ibad*2], bad_regions[ibad*2+1], alpha=0.3, color='gray')
-
-            if self.chi2_window is not None:
-                try:
-                    nwindow = int(self.chi2_window.shape[0]/2)
-                    for iwindow in range(nwindow):
-                        self.axes[ipanel].axvspan(self.chi2_window[iwindow*2, self.y0, self.x0], 
-                            self.chi2_window[iwindow*2+1, self.y0, self.x0], alpha=0.2, color='tab:green')
-                except:
-                    chi2_window_ipanel = self.chi2_window[ipanel]
-                    for iwindow in range(int(chi2_window_ipanel.shape[0]/2)):
-                        self.axes[ipanel].axvspan(chi2_window_ipanel[iwindow*2, self.y0, self.x0], 
-                            chi2_window_ipanel[iwindow*2+1, self.y0, self.x0], alpha=0.2, color='tab:green')
-
+            ax = self.axes[ipanel]
+            self.bm3.add_artist(self.spec_lines[ipanel])
+            self.bm3.add_artist(self.err_lines[ipanel])
+
+            model = model_components(self.models[ipanel](self.xmodels[ipanel], 
+                                        *self.model_popts[ipanel][:,self.y0, self.x0]))
+            lines = []
+            for i in range(len(model)):
+                line, = ax.plot(self.xmodels[ipanel], model[i], 
+                                linestyle=self.linestyles[i], 
+                                c=self.colors[i])
+                self.bm3.add_artist(line)
+                lines.append(line)
+            self.model_lines.append(lines)
+
+            # one collection for the bad regions, which do not depend on the
+            # spaxel and stay in the background, and one for the chi2 windows
+            ax.add_collection(PolyCollection(span_verts(self.bad_regions[ipanel]),
+                              transform=ax.get_xaxis_transform(), alpha=0.3, color='gray'),
+                              autolim=False)
+            windows = PolyCollection(span_verts(self.window_index[self.y0, self.x0, ipanel]),
+                                     transform=ax.get_xaxis_transform(), alpha=0.2,
+                                     color='tab:green')
+            ax.add_collection(windows, autolim=False)
+            self.bm3.add_artist(windows)
+            self.window_collections.append(windows)
+
+            # one text per panel, empty while there are no chi2 maps
+            chi2 = np.nan
             if self.chi2_maps is not None:
-                self.axes[ipanel].text(0.1, 0.9, 
-                    r'$\chi^2_\nu=${:.2f}'.format(self.chi2_maps[ipanel][self.y0, self.x0]), 
-                    transform=self.axes[ipanel].transAxes)  
+                chi2 = self.chi2_maps[ipanel][self.y0, self.x0]
+            txt = ax.text(0.1, 0.9, 
+                r'$\chi^2_\nu=${:.2f}'.format(chi2) if np.isfinite(chi2) else '', 
+                transform=ax.transAxes)  
+            self.bm3.add_artist(txt)
+            self.chi2_texts.append(txt)
 
             # if self.bic_maps is not None:
-            #     self.axes[ipanel].text(0.1, 0.8, 
+            #     ax.text(0.1, 0.8, 
             #         r'BIC={}'.format(self.bic_maps[ipanel][self.y0, self.x0]), 
-            #         transform=self.axes[ipanel].transAxes)        
+            #         transform=ax.transAxes)        
 
+        self.canvas3.draw()
 
     def run(self):
         self.root.mainloop()
-
-
-
-
-
-
-
-
-
-
-
-
-
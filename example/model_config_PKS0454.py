@@ -26,9 +26,16 @@ def return_bad_region_masks():
     return mask1, mask2, mask3
     # return []
 
+chi2_window_fname = '/Users/mandychen/PKS0454-22/eso/mcmc_results/OIIIonly/dynamic_chi2_window.fits'
+
 def return_chi2_window():
     # return 
-    return fits.getdata('/Users/mandychen/PKS0454-22/eso/mcmc_results/OIIIonly/dynamic_chi2_window.fits')
+    return fits.getdata(chi2_window_fname)
+
+def return_chi2_window_files():
+    # files read by return_chi2_window, so the session cache can tell when
+    # they change (optional)
+    return [chi2_window_fname]
 
 
 
@@ -0,0 +1,30 @@
+import shutil
+import argparse
+from fitviz.config import DefineParams
+from fitviz.modelutils import set_lsf_table
+from fitviz.exportutils import read_spaxels, export_panels
+
+def main():
+	parser = argparse.ArgumentParser(description='Render the zoom-in panels of many spaxels to files, without a window.')
+	parser.add_argument('data_config')
+	parser.add_argument('model_config')
+	parser.add_argument('spaxels', help='text file of x y per line, or a 2D FITS mask')
+	parser.add_argument('--outdir', default='.')
+	parser.add_argument('--fmt', default='png', help='png, pdf or any format savefig knows')
+	parser.add_argument('--dpi', type=int, default=150)
+	parser.add_argument('--latex', action='store_true', help='render the text with LaTeX')
+	parser.add_argument('--nproc', type=int, default=None)
+	args = parser.parse_args()
+
+	shutil.copy2(args.model_config, './model_config.py')
+	config_params = DefineParams(args.data_config)
+	if config_params.lsf_fname is not None:
+		set_lsf_table(config_params.lsf_fname)
+
+	spaxels = read_spaxels(args.spaxels)
+	fnames = export_panels(args.data_config, spaxels, args.outdir, args.fmt, args.dpi,
+						   args.latex, args.nproc)
+	print('wrote {} files to {}'.format(len(fnames), args.outdir))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,110 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from astropy.io import fits
+import numpy as np
+from matplotlib.image import imsave
+from fitviz.config import DefineParams
+from fitviz.datautils import Data
+from fitviz.modelutils import get_model_popts, get_chi2_maps, get_bic_maps, set_lsf_table
+from fitviz.displayutils import Displays, savefig_latex
+
+
+def read_spaxels(fname):
+    """Spaxels (y, x) to export, from a 2D FITS mask or a text file.
+
+    All non-zero spaxels of a FITS mask are used; a text file has one
+    spaxel per line as x y, in the same convention as the map display.
+    """
+    if fname.lower().endswith(('.fits', '.fits.gz', '.fit')):
+        mask = np.nan_to_num(fits.getdata(fname))
+        return [(int(y), int(x)) for y, x in np.argwhere(mask != 0)]
+    xy = np.atleast_2d(np.loadtxt(fname, dtype=int, usecols=(0, 1)))
+    return [(int(y), int(x)) for x, y in xy]
+
+class PanelExporter():
+    """Renders the zoom-in panels of any spaxel to a file, without Tk.
+
+    The figures are made once; every export only updates the artists of
+    the panels. PNGs are blitted over the cached background of the panels
+    and written straight from the Agg buffer, other formats (and LaTeX
+    text) go through savefig. The cube is memory-mapped, so that exporters
+    in several processes share the same pages of the file.
+    """
+    def __init__(self, config_fname, outdir='.', fmt='png', dpi=150, latex=False,
+                 stats=None):
+        config_params = DefineParams(config_fname)
+        # worker processes start without the LSF table of the parent, and
+        # the models are made from it in Displays
+        if config_params.lsf_fname is not None:
+            set_lsf_table(config_params.lsf_fname)
+        config_params.lazy_load = True
+        config_params.prefetch = False
+        config_params.payload_cache_mb = 0.
+        # the rotating log is not safe to share between processes
+        config_params.timing_log = None
+        self.outdir, self.fmt, self.dpi, self.latex = outdir, fmt, dpi, latex
+
+        data = Data(config_params)
+        if stats is None:
+            stats = get_chi2_maps(config_params), get_bic_maps(config_params)
+        self.displays = Displays(config_params, data, get_model_popts(config_params),
+                                 *stats, headless=True)
+        self.displays.show_figures()
+        self.blit = fmt == 'png' and not latex
+        if self.blit:
+            self.displays.fig3.set_dpi(dpi)
+            self.displays.canvas3.draw()
+
+    def export(self, y, x):
+        d = self.displays
+        d.ycur, d.xcur = y, x
+        d.update_panels(d.get_payload(y, x), draw=self.blit)
+        fname = os.path.join(self.outdir, 'fitviz_x{}_y{}_panels.{}'.format(x, y, self.fmt))
+        if self.blit:
+            imsave(fname, np.asarray(d.canvas3.buffer_rgba()))
+        elif self.latex:
+            savefig_latex(d.fig3, fname, dpi=self.dpi)
+        else:
+            d.fig3.savefig(fname, dpi=self.dpi)
+        return fname
+
+# one exporter per worker process, made by the pool initializer
+_exporter = None
+
+def _init_worker(*args):
+    global _exporter
+    _exporter = PanelExporter(*args)
+
+def _export_chunk(spaxels):
+    return [_exporter.export(y, x) for y, x in spaxels]
+
+def export_panels(config_fname, spaxels, outdir='.', fmt='png', dpi=150, latex=False,
+                  nproc=None, chunk=16, verbose=True):
+    """Export the panels of every (y, x) in spaxels on nproc processes.
+
+    Each process builds its figures once and then renders chunks of chunk
+    spaxels. If the data config asks for recompute_stats, the chi2 and BIC
+    maps are computed once here and handed to the workers. Returns the
+    names of the files written.
+    """
+    os.makedirs(outdir, exist_ok=True)
+    config_params = DefineParams(config_fname)
+    stats = None
+    if config_params.recompute_stats:
+        displays = PanelExporter(config_fname, outdir, fmt, dpi, latex, (None, None)).displays
+        displays.recompute_stats(nproc=nproc)
+        stats = displays.chi2_maps, displays.bic_maps
+
+    chunks = [spaxels[i:i+chunk] for i in range(0, len(spaxels), chunk)]
+    fnames = []
+    t0 = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=nproc, initializer=_init_worker,
+                             initargs=(config_fname, outdir, fmt, dpi, latex, stats)) as executor:
+        futures = [executor.submit(_export_chunk, c) for c in chunks]
+        for future in as_completed(futures):
+            fnames += future.result()
+            if verbose:
+                print('{:8.1f} s  {}/{} spaxels'.format(time.perf_counter() - t0,
+                                                        len(fnames), len(spaxels)))
+    return fnames
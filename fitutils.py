@@ -0,0 +1,120 @@
+import os
+from astropy.io import fits
+import numpy as np
+from scipy.optimize import least_squares
+from fitviz.batchutils import process_pool
+
+
+def fit_mask(wave, windows, wrange, bad_regions):
+    """Channels of wave used in a fit, as in the chi2 of compute_fit_stats.
+
+    These are the channels inside the chi2 windows (nwindow, 2), or inside
+    wrange = (wmin, wmax) if there are none, and outside the bad regions
+    (nbad, 2). Rows with NaNs are padding and are ignored.
+    """
+    windows = np.asarray(windows, dtype=float).reshape(-1, 2)
+    windows = windows[np.all(np.isfinite(windows), axis=1)]
+    if len(windows) == 0:
+        mask = (wave > wrange[0]) & (wave < wrange[1])
+    else:
+        mask = np.any((wave >= windows[:, :1]) & (wave <= windows[:, 1:]), axis=0)
+    for w0, w1 in np.asarray(bad_regions, dtype=float).reshape(-1, 2):
+        if np.isfinite(w0) and np.isfinite(w1):
+            mask = mask & ~((wave >= w0) & (wave <= w1))
+    return mask
+
+def _total_model(model):
+    # total model, Jacobian and bounds of a model_display function; only
+    # the model and model_display of line complexes from modelutils have
+    # the last two, which are for the LSF-convolved model
+    obj = getattr(model, '__self__', None)
+    if hasattr(obj, 'jacobian') and getattr(model, '__name__', '') in ['model', 'model_display']:
+        return obj.model, obj.jacobian, obj.bounds
+
+    def total(x, *params):
+        m = model(x, *params)
+        return m[0] if isinstance(m, (tuple, list)) else m
+    return total, None, None
+
+def fit_spectrum(model, wave, spec, err, mask, p0, max_nfev=200):
+    """Bounded least-squares fit of a model_display function to one spectrum.
+
+    Only the channels in mask with finite data and positive errors are
+    used. Line complexes are fitted with their analytic Jacobian within
+    their bounds(p0), other models with finite differences and no bounds.
+    Returns the best-fit parameters, the reduced chi2 and the BIC, all NaN
+    if p0 is not finite or there are too few channels.
+    """
+    total, jacobian, bounds = _total_model(model)
+    p0 = np.asarray(p0, dtype=float)
+    npar = len(p0)
+    mask = mask & np.isfinite(spec) & np.isfinite(err) & (err > 0)
+    n = int(mask.sum())
+    if n <= npar or not np.all(np.isfinite(p0)):
+        return np.full(npar, np.nan), np.nan, np.nan
+
+    x, d, w = wave[mask], spec[mask], 1./err[mask]
+    lo, hi = bounds(p0) if bounds is not None else (np.full(npar, -np.inf), np.full(npar, np.inf))
+    fun = lambda p: (total(x, *p) - d)*w
+    jac = '2-point'
+    if jacobian is not None:
+        jac = lambda p: jacobian(x, *p).T*w[:, None]
+    res = least_squares(fun, np.clip(p0, lo, hi), jac=jac, bounds=(lo, hi),
+                        x_scale='jac', max_nfev=max_nfev)
+    chi2 = np.sum(res.fun**2)
+    return res.x, chi2/(n - npar), chi2 + npar*np.log(n)
+
+# spectra fitted in one go by a worker process
+FIT_CHUNK = 16
+
+def _fit_chunk(model, wave, specs, errs, masks, p0s):
+    return [fit_spectrum(model, wave, *args) for args in zip(specs, errs, masks, p0s)]
+
+def fit_spectra(model, wave, specs, errs, masks, p0s, nproc=None, chunk=FIT_CHUNK,
+                executor=None):
+    """fit_spectrum on every row of specs, errs, masks (nspax, nwave) and p0s (nspax, npar).
+
+    Up to chunk spectra are fitted here, more are split in chunks over
+    the processes of executor, or of a new pool of nproc processes.
+    Returns the parameters (nspax, npar), reduced chi2 and BIC (nspax,).
+    """
+    nspax = len(specs)
+    def fit_chunks(executor):
+        futures = [executor.submit(_fit_chunk, model, wave, specs[i:i+chunk], errs[i:i+chunk],
+                                   masks[i:i+chunk], p0s[i:i+chunk])
+                   for i in range(0, nspax, chunk)]
+        return [r for future in futures for r in future.result()]
+
+    if nspax <= chunk:
+        results = _fit_chunk(model, wave, specs, errs, masks, p0s)
+    elif executor is not None:
+        results = fit_chunks(executor)
+    else:
+        if nproc is None: nproc = os.cpu_count()
+        with process_pool(nproc) as executor:
+            results = fit_chunks(executor)
+    popts = np.array([r[0] for r in results]).reshape(nspax, -1)
+    return popts, np.array([r[1] for r in results]), np.array([r[2] for r in results])
+
+def writable(arr):
+    # in-memory copy of a memory-mapped or read-only map, so that refits
+    # never write into the files it was read from
+    if isinstance(arr, np.memmap) or not arr.flags.writeable:
+        return np.array(arr, dtype=float)
+    return arr
+
+def refit_fname(fname, tag='refit'):
+    # cube.fits -> cube_refit.fits, next to the original
+    for ext in ['.fits.gz', '.fits', '.fit']:
+        if fname.endswith(ext):
+            return fname[:-len(ext)] + '_' + tag + ext
+    return fname + '_' + tag + '.fits'
+
+def write_refit(fname, arr, template=None):
+    """Write a refitted map to refit_fname(fname), with the header of template if it exists."""
+    header = None
+    if template is not None and os.path.exists(template):
+        header = fits.getheader(template)
+    out_fname = refit_fname(fname)
+    fits.writeto(out_fname, np.asarray(arr), header=header, overwrite=True)
+    return out_fname
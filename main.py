@@ -2,28 +2,39 @@ import sys
 import shutil
 from fitviz.config import DefineParams
 from fitviz.displayutils import Displays
-from fitviz.datautils import Data
-from fitviz.modelutils import get_model_popts, get_chi2_maps, get_bic_maps
+from fitviz.datautils import Data, load_products
+from fitviz.cacheutils import get_session_cache
+from fitviz.modelutils import get_model_popts, get_chi2_maps, get_bic_maps, set_lsf_table
 
 def main():
 	# parse configuration
 	config_fname = sys.argv[1]
 	model_config_fname = sys.argv[2]
-	shutil.copy(model_config_fname, './model_config.py')
+	# copy2 keeps the mtime, which the session cache checks
+	shutil.copy2(model_config_fname, './model_config.py')
 	config_params = DefineParams(config_fname)
+	if config_params.lsf_fname is not None:
+		set_lsf_table(config_params.lsf_fname)
+
+	# read all maps and model files at once
+	products = load_products(config_params, session_cache=get_session_cache(config_params))
 
 	# read in data
-	data = Data(config_params)
+	data = Data(config_params, products)
 
 	# read in model parameters
-	model_popts = get_model_popts(config_params)
-	chi2_maps = get_chi2_maps(config_params)
-	bic_maps = get_bic_maps(config_params)
+	model_popts = get_model_popts(config_params, products)
+	chi2_maps = bic_maps = None
+	if not config_params.recompute_stats:
+		chi2_maps = get_chi2_maps(config_params, products)
+		bic_maps = get_bic_maps(config_params, products)
 
 	# set up windows
 	displays = Displays(config_params, data, model_popts, chi2_maps, bic_maps)
+	if config_params.recompute_stats:
+		displays.recompute_stats()
 	displays.set_full_window()
 	displays.run()
 
-main()
-	
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,31 @@
+import os
+import sys
+import shutil
+from fitviz.config import DefineParams
+from fitviz.datautils import Data
+from fitviz.modelutils import get_model_popts, set_lsf_table
+from fitviz.batchutils import write_model_cube
+
+def main():
+	# usage: python make_model_cube.py data_config.dat model_config.py ipanel [nproc]
+	config_fname = sys.argv[1]
+	model_config_fname = sys.argv[2]
+	ipanel = int(sys.argv[3])
+	nproc = int(sys.argv[4]) if len(sys.argv) > 4 else None
+	shutil.copy2(model_config_fname, './model_config.py')
+	from fitviz.model_config import return_models
+	config_params = DefineParams(config_fname)
+	if config_params.lsf_fname is not None:
+		set_lsf_table(config_params.lsf_fname)
+
+	data = Data(config_params)
+	model_popts = get_model_popts(config_params)
+	model = return_models()[ipanel]
+
+	# write the cubes next to the best-fit parameters of the panel
+	root = os.path.splitext(config_params.model_path[ipanel] + config_params.model_fname[ipanel])[0]
+	write_model_cube(model, model_popts[ipanel], data, root + '_modelcube.fits',
+					 root + '_residcube.fits', nproc=nproc)
+
+if __name__ == '__main__':
+	main()
@@ -1,4 +1,5 @@
 import os 
+import sys
 import numpy as np  
 from scipy.interpolate import interp1d
 from astropy.io import fits
@@ -7,38 +8,84 @@ from astropy.constants import c
 
 clight = c.value/1e3 # in unit of angstrom/s
 
-def get_chi2_maps(config_params):
+def _read_products(paths, fnames, products=None):
+    all_data = []
+    for i in range(len(paths)):
+        fullpath = paths[i]+fnames[i]
+        if products is not None and fullpath in products:
+            all_data.append(products[fullpath])
+        else:
+            all_data.append(fits.getdata(fullpath))
+    return all_data
+
+def get_chi2_maps(config_params, products=None):
     paths = config_params.chi2_path
     if paths is None: return None
-    fnames = config_params.chi2_fname
-    all_chi2 = []
-    for i in range(len(paths)):
-        all_chi2.append(fits.getdata(paths[i]+fnames[i]))
-    return all_chi2
+    return _read_products(paths, config_params.chi2_fname, products)
 
-def get_bic_maps(config_params):
+def get_bic_maps(config_params, products=None):
     paths = config_params.bic_path
     if paths is None: return None
-    fnames = config_params.bic_fname
-    all_bic = []
-    for i in range(len(paths)):
-        all_bic.append(fits.getdata(paths[i]+fnames[i]))
-    return all_bic
-
-def get_model_popts(config_params):
-    paths = config_params.model_path
-    fnames = config_params.model_fname
-    all_popts = []
-    for i in range(len(paths)):
-        all_popts.append(fits.getdata(paths[i]+fnames[i]))
-    return all_popts
-
-def get_muse_lsf(wave):
-    l0, r0 = np.loadtxt(os.environ['HOME']+'/CUBS/muse_lsf.dat',unpack=True)
-    r = interp1d(l0, r0)(wave)
+    return _read_products(paths, config_params.bic_fname, products)
+
+def get_model_popts(config_params, products=None):
+    return _read_products(config_params.model_path, config_params.model_fname, products)
+
+_lsf_interps = {}
+
+_lsf_table = os.path.expanduser('~/CUBS/muse_lsf.dat')
+
+def set_lsf_table(fname):
+    # resolving power vs. wavelength table used by get_lsf; model configs
+    # import this module as modelutils rather than fitviz.modelutils, so
+    # both copies are updated
+    for name in ['fitviz.modelutils', 'modelutils', __name__]:
+        module = sys.modules.get(name)
+        if module is not None and hasattr(module, '_lsf_table'):
+            module._lsf_table = fname
+
+def get_lsf_table():
+    return _lsf_table
+
+def load_lsf_table(fname=None):
+    """Return the interpolator of the resolving power R(lambda) of a table.
+
+    The two-column text table is parsed once and a binary copy is saved
+    next to it (fname.npz, checked against the size and mtime of the text
+    file), so later sessions skip the text parsing. Interpolators are kept
+    in memory for the rest of the session.
+    """
+    if fname is None: fname = get_lsf_table()
+    if fname in _lsf_interps:
+        return _lsf_interps[fname]
+
+    st = os.stat(fname)
+    source = np.array([st.st_size, st.st_mtime])
+    bin_fname = fname + '.npz'
+    l0 = r0 = None
+    if os.path.exists(bin_fname):
+        with np.load(bin_fname) as table:
+            if np.array_equal(table['source'], source):
+                l0, r0 = table['l0'], table['r0']
+    if l0 is None:
+        l0, r0 = np.loadtxt(fname, unpack=True)
+        try:
+            np.savez(bin_fname, l0=l0, r0=r0, source=source)
+        except OSError:
+            pass
+
+    _lsf_interps[fname] = interp1d(l0, r0)
+    return _lsf_interps[fname]
+
+def get_lsf(wave, fname=None):
+    # FWHM of the LSF in km/s at wave, which can be an array of any shape
+    r = load_lsf_table(fname)(wave)
     lsf = clight/r
     return lsf
 
+def get_muse_lsf(wave):
+    return get_lsf(wave)
+
 def gauss(x, mu, sig, n):
     return n*np.exp(-(x-mu)**2/(2*sig**2))
 
@@ -46,404 +93,225 @@ def convolve_lsf(sig, lsf):
     a = 2*np.sqrt(2*np.log(2))
     return np.sqrt(sig**2+(lsf/a)**2)
 
-class GaussSingleLine():
-    def __init__(self, lam0, lsf):
-        self.lam0 = lam0
-        self.lsf = lsf  
-
-    def model(self, x, z, sig, n):
-        return gauss(x, self.lam0*(1. + z), 
-            convolve_lsf(sig, self.lsf)/clight*self.lam0*(1. + z), n)
-
-class O2_1comp():
-    def __init__(self, lam0, lsf):
+class LineComplex():
+    """Gaussian line complex with any number of kinematic components.
+
+    Every component has a redshift z, a velocity dispersion sig (km/s) and an
+    amplitude n, followed by one ratio parameter for each line with a free
+    amplitude ratio. ratios gives the amplitude of each line relative to n,
+    either a number (fixed ratio) or None (free ratio). All lines of all
+    components are evaluated in one pass on a (component, line, wavelength)
+    grid. display sets what model_display returns: 'lines' for every line of
+    every component, 'components' for the sum of each component and 'total'
+    for the total model only, after the total in the first two cases.
+    """
+    def __init__(self, lam0, lsf, ratios, ncomp, display='components'):
         self.lam0 = lam0
         self.lsf = lsf
-
-    def model(self, x, z1, sig1, n1, ratio1):
-        # note that n1 parameter is the amp. of blue component (3727A)
-        n1_red = n1*ratio1
-        g1_blue = gauss(x, self.lam0[0]*(1. + z1), 
-            convolve_lsf(sig1, self.lsf[0])/clight*self.lam0[0]*(1. + z1),
-            n1)
-        g1_red = gauss(x, self.lam0[1]*(1. + z1), 
-            convolve_lsf(sig1, self.lsf[1])/clight*self.lam0[1]*(1. + z1), 
-            n1_red)
-        return g1_blue + g1_red   
-
-    def model_display(self, x, z1, sig1, n1, ratio1):
-        n1_red = n1*ratio1
-        g1_blue = gauss(x, self.lam0[0]*(1. + z1), 
-            convolve_lsf(sig1, self.lsf[0])/clight*self.lam0[0]*(1. + z1),
-            n1)
-        g1_red = gauss(x, self.lam0[1]*(1. + z1), 
-            convolve_lsf(sig1, self.lsf[1])/clight*self.lam0[1]*(1. + z1), 
-            n1_red)
-        return (g1_blue + g1_red, 
-            g1_blue, g1_red)  
-
-class O2_2comp():
+        self.ratios = ratios
+        self.ncomp = ncomp
+        self.display = display
+        self._lam0 = np.atleast_1d(np.asarray(lam0, dtype=float))
+        self._lsf = np.atleast_1d(np.asarray(lsf, dtype=float))
+        self._fixed = np.array([1. if r is None else r for r in ratios], dtype=float)
+        self._free = np.flatnonzero([r is None for r in ratios])
+        self.npar_comp = 3 + len(self._free)
+        self.npar = self.npar_comp*ncomp
+
+    @property
+    def param_names(self):
+        names = []
+        for i in range(1, self.ncomp + 1):
+            names += ['z%d' % i, 'sig%d' % i, 'n%d' % i]
+            names += ['ratio%d' % i if len(self._free) == 1 else 'ratio%d_%d' % (i, j)
+                      for j in self._free]
+        return names
+
+    def _unpack(self, params):
+        p = np.asarray(params, dtype=float).reshape(self.ncomp, self.npar_comp)
+        z, sig, n = p[:, 0], p[:, 1], p[:, 2]
+        amp = n[:, None]*self._fixed[None, :]
+        amp[:, self._free] *= p[:, 3:]
+        return z, sig, amp
+
+    def grid(self, x, *params, lsf=True):
+        """Evaluate every line of every component, shape (ncomp, nline) + x.shape.
+
+        With lsf=False the lines are not broadened by the LSF, and the
+        amplitudes are scaled up to conserve the flux of the broadened lines.
+        """
+        z, sig, amp = self._unpack(params)
+        mu = self._lam0[None, :]*(1. + z[:, None])
+        if lsf:
+            sig_v = convolve_lsf(sig[:, None], self._lsf[None, :])
+        else:
+            sig_v = sig[:, None]
+            # correct for narrowed line width without lsf
+            amp = amp*(convolve_lsf(sig, self._lsf[0])/sig)[:, None]
+        sig_lam = sig_v/clight*mu
+
+        x = np.asarray(x, dtype=float)
+        expand = (Ellipsis,) + (None,)*x.ndim
+        return gauss(x, mu[expand], sig_lam[expand], amp[expand])
+
+    def _display(self, g):
+        total = g.sum(axis=(0, 1))
+        if self.display == 'lines':
+            return (total,) + tuple(g.reshape((-1,) + g.shape[2:]))
+        if self.display == 'components':
+            return (total,) + tuple(g.sum(axis=1))
+        return total
+
+    def model(self, x, *params):
+        return self.grid(x, *params).sum(axis=(0, 1))
+
+    def model_spectra(self, wave, popts, nsigma=5.):
+        """Evaluate the total model of many spaxels on a sorted wave grid.
+
+        popts has shape (npar, nspax) and the result (nspax, nwave). Each line
+        is only evaluated on the channels within nsigma of its centre, and
+        spaxels with non-finite parameters are set to NaN.
+        """
+        wave = np.asarray(wave, dtype=float)
+        popts = np.asarray(popts, dtype=float).reshape(self.npar, -1)
+        nspax, nwave = popts.shape[1], len(wave)
+
+        p = popts.T.reshape(nspax, self.ncomp, self.npar_comp)
+        z, sig, n = p[..., 0], p[..., 1], p[..., 2]
+        amp = n[..., None]*self._fixed
+        amp[..., self._free] *= p[..., 3:]
+        mu = self._lam0*(1. + z[..., None])
+        sig_lam = convolve_lsf(sig[..., None], self._lsf)/clight*mu
+
+        finite = np.all(np.isfinite(popts), axis=0)
+        good = finite[:, None, None] & (sig_lam > 0)
+        lo = np.searchsorted(wave, np.where(good, mu - nsigma*sig_lam, 0.))
+        hi = np.searchsorted(wave, np.where(good, mu + nsigma*sig_lam, 0.))
+        width = (hi - lo)[good].max() if good.any() else 0
+
+        out = np.zeros(nspax*nwave)
+        if width > 0:
+            # (spaxel, component, line, channel) indices of the evaluated channels
+            idx = lo[..., None] + np.arange(width)
+            valid = good[..., None] & (idx < hi[..., None])
+            idx = idx[valid]
+            rows = np.broadcast_to(np.arange(nspax)[:, None, None, None], valid.shape)[valid]
+            expand = (Ellipsis, None)
+            g = gauss(wave[idx], np.broadcast_to(mu[expand], valid.shape)[valid],
+                      np.broadcast_to(sig_lam[expand], valid.shape)[valid],
+                      np.broadcast_to(amp[expand], valid.shape)[valid])
+            out += np.bincount(rows*nwave + idx, weights=g, minlength=nspax*nwave)
+        out = out.reshape(nspax, nwave)
+        out[~finite] = np.nan
+        return out
+
+    def model_display_sum(self, x, popts, chunk=256):
+        """Sum of model_display(x, *popt) over the spaxels of popts (npar, nspax).
+
+        The spaxels are evaluated chunk at a time on a (spaxel, component,
+        line, x) grid.
+        """
+        x = np.asarray(x, dtype=float)
+        popts = np.asarray(popts, dtype=float).reshape(self.npar, -1)
+        g_sum = np.zeros((self.ncomp, len(self._lam0)) + x.shape)
+        for i0 in range(0, popts.shape[1], chunk):
+            p = popts[:, i0:i0+chunk].T.reshape(-1, self.ncomp, self.npar_comp)
+            z, sig, n = p[..., 0], p[..., 1], p[..., 2]
+            amp = n[..., None]*self._fixed
+            amp[..., self._free] *= p[..., 3:]
+            mu = self._lam0*(1. + z[..., None])
+            sig_lam = convolve_lsf(sig[..., None], self._lsf)/clight*mu
+            expand = (Ellipsis,) + (None,)*x.ndim
+            g_sum += gauss(x, mu[expand], sig_lam[expand], amp[expand]).sum(axis=0)
+        return self._display(g_sum)
+
+    def jacobian(self, x, *params):
+        """Derivatives of model(x, *params) with respect to params, shape (npar,) + x.shape."""
+        z, sig, amp = self._unpack(params)
+        p = np.asarray(params, dtype=float).reshape(self.ncomp, self.npar_comp)
+        mu = self._lam0[None, :]*(1. + z[:, None])
+        sig_v = convolve_lsf(sig[:, None], self._lsf[None, :])
+        sig_lam = sig_v/clight*mu
+
+        x = np.asarray(x, dtype=float)
+        expand = (Ellipsis,) + (None,)*x.ndim
+        u = (x - mu[expand])/sig_lam[expand]
+        e = np.exp(-0.5*u**2)
+        g = amp[expand]*e
+        # sig_lam grows with mu, hence the u**2/mu term
+        dz = (g*(u/sig_lam[expand] + u**2/mu[expand])*(mu/(1. + z[:, None]))[expand]).sum(axis=1)
+        dsig = (g*u**2*(sig[:, None]/sig_v/sig_v)[expand]).sum(axis=1)
+        unit = np.broadcast_to(self._fixed, amp.shape).copy()
+        unit[:, self._free] *= p[:, 3:]
+        dn = (unit[expand]*e).sum(axis=1)
+        dratio = (p[:, 2, None]*self._fixed[self._free])[expand]*e[:, self._free]
+
+        jac = np.concatenate([dz[:, None], dsig[:, None], dn[:, None], dratio], axis=1)
+        return jac.reshape((self.npar,) + x.shape)
+
+    def bounds(self, params, dv=1000., sig_max=2000.):
+        """Bounds for fits starting from params: z within dv km/s, 0 <= sig <= sig_max,
+        non-negative amplitudes and ratios."""
+        p = np.asarray(params, dtype=float).reshape(self.ncomp, self.npar_comp)
+        dz = dv/clight*(1. + p[:, 0])
+        lo = np.zeros_like(p)
+        hi = np.full_like(p, np.inf)
+        lo[:, 0], hi[:, 0] = p[:, 0] - dz, p[:, 0] + dz
+        hi[:, 1] = sig_max
+        return lo.ravel(), hi.ravel()
+
+    def model_nolsf(self, x, *params):
+        return self.grid(x, *params, lsf=False).sum(axis=(0, 1))
+
+    def model_display(self, x, *params):
+        return self._display(self.grid(x, *params))
+
+    def model_nolsf_display(self, x, *params):
+        return self._display(self.grid(x, *params, lsf=False))
+
+class GaussSingleLine(LineComplex):
     def __init__(self, lam0, lsf):
-        self.lam0 = lam0
-        self.lsf = lsf
+        super().__init__(lam0, lsf, ratios=[1.], ncomp=1, display='total')
+
+class O2_ncomp(LineComplex):
+    # [OII] 3727,3729 doublet with a free ratio per component:
+    # parameters are z, sig, n, ratio for each component, where n is the
+    # amp. of the blue line (3727A) and ratio the red-to-blue amp. ratio
+    def __init__(self, lam0, lsf, ncomp):
+        super().__init__(lam0, lsf, ratios=[1., None], ncomp=ncomp, display='lines')
+
+class O3_ncomp(LineComplex):
+    # [OIII] 4960,5008 doublet with the fixed 1:3 ratio:
+    # parameters are z, sig, n for each component, where n is the amp. of
+    # the red line (5008A)
+    def __init__(self, lam0, lsf, ncomp):
+        super().__init__(lam0, lsf, ratios=[1./3., 1.], ncomp=ncomp,
+                         display='total' if ncomp == 1 else 'components')
+
+class O2_1comp(O2_ncomp):
+    def __init__(self, lam0, lsf):
+        super().__init__(lam0, lsf, ncomp=1)
 
-    def model(self, x, z1, sig1, n1, ratio1, z2, sig2, n2, ratio2):
-        # note that n1 parameter is the amp. of blue component (3727A)
-        n1_red = n1*ratio1
-        g1_blue = gauss(x, self.lam0[0]*(1. + z1), 
-            convolve_lsf(sig1, self.lsf[0])/clight*self.lam0[0]*(1. + z1),
-            n1)
-        g1_red = gauss(x, self.lam0[1]*(1. + z1), 
-            convolve_lsf(sig1, self.lsf[1])/clight*self.lam0[1]*(1. + z1), 
-            n1_red)
-
-        n2_red = n2*ratio2
-        g2_blue = gauss(x, self.lam0[0]*(1. + z2), 
-            convolve_lsf(sig2, self.lsf[0])/clight*self.lam0[0]*(1. + z2),
-            n2)
-        g2_red = gauss(x, self.lam0[1]*(1. + z2), 
-            convolve_lsf(sig2, self.lsf[1])/clight*self.lam0[1]*(1. + z2), 
-            n2_red)
-        return g1_blue + g1_red + g2_blue + g2_red   
-
-    def model_display(self, x, z1, sig1, n1, ratio1, z2, sig2, n2, ratio2):
-        # note that n1 parameter is the amp. of blue component (3727A)
-        n1_red = n1*ratio1
-        g1_blue = gauss(x, self.lam0[0]*(1. + z1), 
-            convolve_lsf(sig1, self.lsf[0])/clight*self.lam0[0]*(1. + z1),
-            n1)
-        g1_red = gauss(x, self.lam0[1]*(1. + z1), 
-            convolve_lsf(sig1, self.lsf[1])/clight*self.lam0[1]*(1. + z1), 
-            n1_red)
-
-        n2_red = n2*ratio2
-        g2_blue = gauss(x, self.lam0[0]*(1. + z2), 
-            convolve_lsf(sig2, self.lsf[0])/clight*self.lam0[0]*(1. + z2),
-            n2)
-        g2_red = gauss(x, self.lam0[1]*(1. + z2), 
-            convolve_lsf(sig2, self.lsf[1])/clight*self.lam0[1]*(1. + z2), 
-            n2_red)
-        return (g1_blue + g1_red + g2_blue + g2_red,
-                g1_blue, g1_red, g2_blue, g2_red )  
-
-class O3_1comp():
+class O2_2comp(O2_ncomp):
     def __init__(self, lam0, lsf):
-        self.lam0 = lam0
-        self.lsf = lsf
+        super().__init__(lam0, lsf, ncomp=2)
 
-    def model(self, x, z1, sig1, n1):
-        # note that n1 parameter is the amp. of red component (5008A)
-        n1_blue = n1/3.
-        g1_blue = gauss(x, self.lam0[0]*(1. + z1), 
-            convolve_lsf(sig1, self.lsf[0])/clight*self.lam0[0]*(1. + z1),
-            n1_blue)
-        g1_red = gauss(x, self.lam0[1]*(1. + z1), 
-            convolve_lsf(sig1, self.lsf[1])/clight*self.lam0[1]*(1. + z1), 
-            n1)
-        return g1_blue + g1_red
-
-    def model_nolsf(self, x, z1, sig1, n1):
-        # note that n1 parameter is the amp. of red component (5008A)
-        sig1_convolved = convolve_lsf(sig1, self.lsf[0])
-        n1 = n1*sig1_convolved/sig1 # correct for narrowed line width without lsf
-        n1_blue = n1/3.
-        g1_blue = gauss(x, self.lam0[0]*(1. + z1), 
-            sig1/clight*self.lam0[0]*(1. + z1),
-            n1_blue)
-        g1_red = gauss(x, self.lam0[1]*(1. + z1), 
-            sig1/clight*self.lam0[1]*(1. + z1), 
-            n1)
-        return g1_blue + g1_red
-
-    def model_display(self, x, z1, sig1, n1):
-        return self.model(x, z1, sig1, n1)
-
-    def model_nolsf_display(self, x, z1, sig1, n1):
-        return self.model_nolsf(x, z1, sig1, n1)
-
-class O3_2comp():
+class O3_1comp(O3_ncomp):
     def __init__(self, lam0, lsf):
-        self.lam0 = lam0
-        self.lsf = lsf
+        super().__init__(lam0, lsf, ncomp=1)
 
-    def model(self, x, z1, sig1, n1, z2, sig2, n2):
-        n1_blue = n1/3.
-        g1_blue = gauss(x, self.lam0[0]*(1. + z1), 
-            convolve_lsf(sig1, self.lsf[0])/clight*self.lam0[0]*(1. + z1),
-            n1_blue)
-        g1_red = gauss(x, self.lam0[1]*(1. + z1), 
-            convolve_lsf(sig1, self.lsf[1])/clight*self.lam0[1]*(1. + z1), 
-            n1)
-        n2_blue = n2/3.
-        g2_blue = gauss(x, self.lam0[0]*(1. + z2), 
-            convolve_lsf(sig2, self.lsf[0])/clight*self.lam0[0]*(1. + z2),
-            n2_blue)
-        g2_red = gauss(x, self.lam0[1]*(1. + z2), 
-            convolve_lsf(sig2, self.lsf[1])/clight*self.lam0[1]*(1. + z2), 
-            n2)
-        return g1_blue + g1_red + g2_blue + g2_red
-
-    def model_nolsf(self, x, z1, sig1, n1, z2, sig2, n2):
-        sig1_convolved = convolve_lsf(sig1, self.lsf[0])
-        n1 = n1*sig1_convolved/sig1 # correct for narrowed line width without lsf
-        n1_blue = n1/3.
-        g1_blue = gauss(x, self.lam0[0]*(1. + z1), 
-            sig1/clight*self.lam0[0]*(1. + z1),
-            n1_blue)
-        g1_red = gauss(x, self.lam0[1]*(1. + z1), 
-            sig1/clight*self.lam0[1]*(1. + z1), 
-            n1)
-        sig2_convolved = convolve_lsf(sig2, self.lsf[0])
-        n2 = n2*sig2_convolved/sig2 # correct for narrowed line width without lsf
-        n2_blue = n2/3.
-        g2_blue = gauss(x, self.lam0[0]*(1. + z2), 
-            sig2/clight*self.lam0[0]*(1. + z2),
-            n2_blue)
-        g2_red = gauss(x, self.lam0[1]*(1. + z2), 
-            sig2/clight*self.lam0[1]*(1. + z2), 
-            n2)
-        return g1_blue + g1_red + g2_blue + g2_red
-
-    def model_display(self, x, z1, sig1, n1, z2, sig2, n2):
-        n1_blue = n1/3.
-        g1_blue = gauss(x, self.lam0[0]*(1. + z1), 
-            convolve_lsf(sig1, self.lsf[0])/clight*self.lam0[0]*(1. + z1),
-            n1_blue)
-        g1_red = gauss(x, self.lam0[1]*(1. + z1), 
-            convolve_lsf(sig1, self.lsf[1])/clight*self.lam0[1]*(1. + z1), 
-            n1)
-        n2_blue = n2/3.
-        g2_blue = gauss(x, self.lam0[0]*(1. + z2), 
-            convolve_lsf(sig2, self.lsf[0])/clight*self.lam0[0]*(1. + z2),
-            n2_blue)
-        g2_red = gauss(x, self.lam0[1]*(1. + z2), 
-            convolve_lsf(sig2, self.lsf[1])/clight*self.lam0[1]*(1. + z2), 
-            n2)
-        return (g1_blue + g1_red + g2_blue + g2_red, 
-                g1_blue + g1_red, g2_blue + g2_red) 
-
-    def model_nolsf_display(self, x, z1, sig1, n1, z2, sig2, n2):
-        sig1_convolved = convolve_lsf(sig1, self.lsf[0])
-        n1 = n1*sig1_convolved/sig1 # correct for narrowed line width without lsf
-        n1_blue = n1/3.
-        g1_blue = gauss(x, self.lam0[0]*(1. + z1), 
-            sig1/clight*self.lam0[0]*(1. + z1),
-            n1_blue)
-        g1_red = gauss(x, self.lam0[1]*(1. + z1), 
-            sig1/clight*self.lam0[1]*(1. + z1), 
-            n1)
-        sig2_convolved = convolve_lsf(sig2, self.lsf[0])
-        n2 = n2*sig2_convolved/sig2 # correct for narrowed line width without lsf
-        n2_blue = n2/3.
-        g2_blue = gauss(x, self.lam0[0]*(1. + z2), 
-            sig2/clight*self.lam0[0]*(1. + z2),
-            n2_blue)
-        g2_red = gauss(x, self.lam0[1]*(1. + z2), 
-            sig2/clight*self.lam0[1]*(1. + z2), 
-            n2)
-        return (g1_blue + g1_red + g2_blue + g2_red,
-                g1_blue + g1_red, g2_blue + g2_red)
-
-class O3_3comp():
+class O3_2comp(O3_ncomp):
     def __init__(self, lam0, lsf):
-        self.lam0 = lam0
-        self.lsf = lsf
+        super().__init__(lam0, lsf, ncomp=2)
 
-    def model(self, x, z1, sig1, n1, z2, sig2, n2, z3, sig3, n3):
-        n1_blue = n1/3.
-        g1_blue = gauss(x, self.lam0[0]*(1. + z1), 
-            convolve_lsf(sig1, self.lsf[0])/clight*self.lam0[0]*(1. + z1),
-            n1_blue)
-        g1_red = gauss(x, self.lam0[1]*(1. + z1), 
-            convolve_lsf(sig1, self.lsf[1])/clight*self.lam0[1]*(1. + z1), 
-            n1)
-        n2_blue = n2/3.
-        g2_blue = gauss(x, self.lam0[0]*(1. + z2), 
-            convolve_lsf(sig2, self.lsf[0])/clight*self.lam0[0]*(1. + z2),
-            n2_blue)
-        g2_red = gauss(x, self.lam0[1]*(1. + z2), 
-            convolve_lsf(sig2, self.lsf[1])/clight*self.lam0[1]*(1. + z2), 
-            n2)
-        n3_blue = n3/3.
-        g3_blue = gauss(x, self.lam0[0]*(1. + z3), 
-            convolve_lsf(sig3, self.lsf[0])/clight*self.lam0[0]*(1. + z3),
-            n3_blue)
-        g3_red = gauss(x, self.lam0[1]*(1. + z3), 
-            convolve_lsf(sig3, self.lsf[1])/clight*self.lam0[1]*(1. + z3), 
-            n3)
-        return g1_blue + g1_red + g2_blue + g2_red + g3_blue + g3_red
-
-    def model_display(self, x, z1, sig1, n1, z2, sig2, n2, z3, sig3, n3):
-        n1_blue = n1/3.
-        g1_blue = gauss(x, self.lam0[0]*(1. + z1), 
-            convolve_lsf(sig1, self.lsf[0])/clight*self.lam0[0]*(1. + z1),
-            n1_blue)
-        g1_red = gauss(x, self.lam0[1]*(1. + z1), 
-            convolve_lsf(sig1, self.lsf[1])/clight*self.lam0[1]*(1. + z1), 
-            n1)
-        n2_blue = n2/3.
-        g2_blue = gauss(x, self.lam0[0]*(1. + z2), 
-            convolve_lsf(sig2, self.lsf[0])/clight*self.lam0[0]*(1. + z2),
-            n2_blue)
-        g2_red = gauss(x, self.lam0[1]*(1. + z2), 
-            convolve_lsf(sig2, self.lsf[1])/clight*self.lam0[1]*(1. + z2), 
-            n2)
-        n3_blue = n3/3.
-        g3_blue = gauss(x, self.lam0[0]*(1. + z3), 
-            convolve_lsf(sig3, self.lsf[0])/clight*self.lam0[0]*(1. + z3),
-            n3_blue)
-        g3_red = gauss(x, self.lam0[1]*(1. + z3), 
-            convolve_lsf(sig3, self.lsf[1])/clight*self.lam0[1]*(1. + z3), 
-            n3)
-        return (g1_blue + g1_red + g2_blue + g2_red + g3_blue + g3_red,
-                g1_blue + g1_red, g2_blue + g2_red, g3_blue + g3_red)
-
-class O3_4comp():
+class O3_3comp(O3_ncomp):
     def __init__(self, lam0, lsf):
-        self.lam0 = lam0
-        self.lsf = lsf
+        super().__init__(lam0, lsf, ncomp=3)
 
-    def model(self, x, z1, sig1, n1, z2, sig2, n2, z3, sig3, n3, z4, sig4, n4):
-        n1_blue = n1/3.
-        g1_blue = gauss(x, self.lam0[0]*(1. + z1), 
-            convolve_lsf(sig1, self.lsf[0])/clight*self.lam0[0]*(1. + z1),
-            n1_blue)
-        g1_red = gauss(x, self.lam0[1]*(1. + z1), 
-            convolve_lsf(sig1, self.lsf[1])/clight*self.lam0[1]*(1. + z1), 
-            n1)
-        n2_blue = n2/3.
-        g2_blue = gauss(x, self.lam0[0]*(1. + z2), 
-            convolve_lsf(sig2, self.lsf[0])/clight*self.lam0[0]*(1. + z2),
-            n2_blue)
-        g2_red = gauss(x, self.lam0[1]*(1. + z2), 
-            convolve_lsf(sig2, self.lsf[1])/clight*self.lam0[1]*(1. + z2), 
-            n2)
-        n3_blue = n3/3.
-        g3_blue = gauss(x, self.lam0[0]*(1. + z3), 
-            convolve_lsf(sig3, self.lsf[0])/clight*self.lam0[0]*(1. + z3),
-            n3_blue)
-        g3_red = gauss(x, self.lam0[1]*(1. + z3), 
-            convolve_lsf(sig3, self.lsf[1])/clight*self.lam0[1]*(1. + z3), 
-            n3)
-        n4_blue = n4/3.
-        g4_blue = gauss(x, self.lam0[0]*(1. + z4), 
-            convolve_lsf(sig4, self.lsf[0])/clight*self.lam0[0]*(1. + z4),
-            n4_blue)
-        g4_red = gauss(x, self.lam0[1]*(1. + z4), 
-            convolve_lsf(sig4, self.lsf[1])/clight*self.lam0[1]*(1. + z4), 
-            n4)
-        return g1_blue + g1_red + g2_blue + g2_red + g3_blue + g3_red + g4_blue + g4_red
-
-    def model_display(self, x, z1, sig1, n1, z2, sig2, n2, z3, sig3, n3, z4, sig4, n4):
-        n1_blue = n1/3.
-        g1_blue = gauss(x, self.lam0[0]*(1. + z1), 
-            convolve_lsf(sig1, self.lsf[0])/clight*self.lam0[0]*(1. + z1),
-            n1_blue)
-        g1_red = gauss(x, self.lam0[1]*(1. + z1), 
-            convolve_lsf(sig1, self.lsf[1])/clight*self.lam0[1]*(1. + z1), 
-            n1)
-        n2_blue = n2/3.
-        g2_blue = gauss(x, self.lam0[0]*(1. + z2), 
-            convolve_lsf(sig2, self.lsf[0])/clight*self.lam0[0]*(1. + z2),
-            n2_blue)
-        g2_red = gauss(x, self.lam0[1]*(1. + z2), 
-            convolve_lsf(sig2, self.lsf[1])/clight*self.lam0[1]*(1. + z2), 
-            n2)
-        n3_blue = n3/3.
-        g3_blue = gauss(x, self.lam0[0]*(1. + z3), 
-            convolve_lsf(sig3, self.lsf[0])/clight*self.lam0[0]*(1. + z3),
-            n3_blue)
-        g3_red = gauss(x, self.lam0[1]*(1. + z3), 
-            convolve_lsf(sig3, self.lsf[1])/clight*self.lam0[1]*(1. + z3), 
-            n3)
-        n4_blue = n4/3.
-        g4_blue = gauss(x, self.lam0[0]*(1. + z4), 
-            convolve_lsf(sig4, self.lsf[0])/clight*self.lam0[0]*(1. + z4),
-            n4_blue)
-        g4_red = gauss(x, self.lam0[1]*(1. + z4), 
-            convolve_lsf(sig4, self.lsf[1])/clight*self.lam0[1]*(1. + z4), 
-            n4)
-        return (g1_blue + g1_red + g2_blue + g2_red + g3_blue + g3_red + g4_blue + g4_red,
-            g1_blue + g1_red, g2_blue + g2_red, g3_blue + g3_red, g4_blue + g4_red)
-
-class O3_5comp():
+class O3_4comp(O3_ncomp):
     def __init__(self, lam0, lsf):
-        self.lam0 = lam0
-        self.lsf = lsf
+        super().__init__(lam0, lsf, ncomp=4)
 
-    def model(self, x, z1, sig1, n1, z2, sig2, n2, z3, sig3, n3, z4, sig4, n4, z5, sig5, n5):
-        n1_blue = n1/3.
-        g1_blue = gauss(x, self.lam0[0]*(1. + z1), 
-            convolve_lsf(sig1, self.lsf[0])/clight*self.lam0[0]*(1. + z1),
-            n1_blue)
-        g1_red = gauss(x, self.lam0[1]*(1. + z1), 
-            convolve_lsf(sig1, self.lsf[1])/clight*self.lam0[1]*(1. + z1), 
-            n1)
-        n2_blue = n2/3.
-        g2_blue = gauss(x, self.lam0[0]*(1. + z2), 
-            convolve_lsf(sig2, self.lsf[0])/clight*self.lam0[0]*(1. + z2),
-            n2_blue)
-        g2_red = gauss(x, self.lam0[1]*(1. + z2), 
-            convolve_lsf(sig2, self.lsf[1])/clight*self.lam0[1]*(1. + z2), 
-            n2)
-        n3_blue = n3/3.
-        g3_blue = gauss(x, self.lam0[0]*(1. + z3), 
-            convolve_lsf(sig3, self.lsf[0])/clight*self.lam0[0]*(1. + z3),
-            n3_blue)
-        g3_red = gauss(x, self.lam0[1]*(1. + z3), 
-            convolve_lsf(sig3, self.lsf[1])/clight*self.lam0[1]*(1. + z3), 
-            n3)
-        n4_blue = n4/3.
-        g4_blue = gauss(x, self.lam0[0]*(1. + z4), 
-            convolve_lsf(sig4, self.lsf[0])/clight*self.lam0[0]*(1. + z4),
-            n4_blue)
-        g4_red = gauss(x, self.lam0[1]*(1. + z4), 
-            convolve_lsf(sig4, self.lsf[1])/clight*self.lam0[1]*(1. + z4), 
-            n4)
-        n5_blue = n5/3.
-        g5_blue = gauss(x, self.lam0[0]*(1. + z5), 
-            convolve_lsf(sig5, self.lsf[0])/clight*self.lam0[0]*(1. + z5),
-            n5_blue)
-        g5_red = gauss(x, self.lam0[1]*(1. + z5), 
-            convolve_lsf(sig5, self.lsf[1])/clight*self.lam0[1]*(1. + z5), 
-            n5)
-        return g1_blue + g1_red + g2_blue + g2_red + g3_blue + g3_red + g4_blue + g4_red + g5_blue + g5_red
-
-    def model_display(self, x, z1, sig1, n1, z2, sig2, n2, z3, sig3, n3, z4, sig4, n4, z5, sig5, n5):
-        n1_blue = n1/3.
-        g1_blue = gauss(x, self.lam0[0]*(1. + z1), 
-            convolve_lsf(sig1, self.lsf[0])/clight*self.lam0[0]*(1. + z1),
-            n1_blue)
-        g1_red = gauss(x, self.lam0[1]*(1. + z1), 
-            convolve_lsf(sig1, self.lsf[1])/clight*self.lam0[1]*(1. + z1), 
-            n1)
-        n2_blue = n2/3.
-        g2_blue = gauss(x, self.lam0[0]*(1. + z2), 
-            convolve_lsf(sig2, self.lsf[0])/clight*self.lam0[0]*(1. + z2),
-            n2_blue)
-        g2_red = gauss(x, self.lam0[1]*(1. + z2), 
-            convolve_lsf(sig2, self.lsf[1])/clight*self.lam0[1]*(1. + z2), 
-            n2)
-        n3_blue = n3/3.
-        g3_blue = gauss(x, self.lam0[0]*(1. + z3), 
-            convolve_lsf(sig3, self.lsf[0])/clight*self.lam0[0]*(1. + z3),
-            n3_blue)
-        g3_red = gauss(x, self.lam0[1]*(1. + z3), 
-            convolve_lsf(sig3, self.lsf[1])/clight*self.lam0[1]*(1. + z3), 
-            n3)
-        n4_blue = n4/3.
-        g4_blue = gauss(x, self.lam0[0]*(1. + z4), 
-            convolve_lsf(sig4, self.lsf[0])/clight*self.lam0[0]*(1. + z4),
-            n4_blue)
-        g4_red = gauss(x, self.lam0[1]*(1. + z4), 
-            convolve_lsf(sig4, self.lsf[1])/clight*self.lam0[1]*(1. + z4), 
-            n4)
-        n5_blue = n5/3.
-        g5_blue = gauss(x, self.lam0[0]*(1. + z5), 
-            convolve_lsf(sig5, self.lsf[0])/clight*self.lam0[0]*(1. + z5),
-            n5_blue)
-        g5_red = gauss(x, self.lam0[1]*(1. + z5), 
-            convolve_lsf(sig5, self.lsf[1])/clight*self.lam0[1]*(1. + z5), 
-            n5)
-        return (g1_blue + g1_red + g2_blue + g2_red + g3_blue + g3_red + g4_blue + g4_red + g5_blue + g5_red,
-            g1_blue + g1_red, g2_blue + g2_red, g3_blue + g3_red, g4_blue + g4_red, g5_blue + g5_red)
\ No newline at end of file
+class O3_5comp(O3_ncomp):
+    def __init__(self, lam0, lsf):
+        super().__init__(lam0, lsf, ncomp=5)
@@ -0,0 +1,55 @@
+import numpy as np
+
+
+class SpectralPyramid():
+    """Min/max envelopes of a spectrum at successive factors of 2.
+
+    Level 0 is the spectrum itself and level k holds the min and max over
+    blocks of 2**k channels, down to at most nmin blocks. envelope() then
+    only has to reduce the level closest to the requested resolution, so
+    its cost depends on the number of screen pixels and not on the length
+    of the spectrum.
+    """
+    def __init__(self, x, y, nmin=64):
+        self.x = np.asarray(x)
+        lo = hi = np.asarray(y)
+        self.levels = [(lo, hi)]
+        while len(lo) >= 2*nmin:
+            if len(lo) % 2:
+                lo, hi = np.append(lo, lo[-1]), np.append(hi, hi[-1])
+            lo = np.fmin(lo[0::2], lo[1::2])
+            hi = np.fmax(hi[0::2], hi[1::2])
+            self.levels.append((lo, hi))
+
+    @property
+    def nbytes(self):
+        # level 0 holds the spectrum once
+        return (self.x.nbytes + self.levels[0][0].nbytes +
+                sum(lo.nbytes + hi.nbytes for lo, hi in self.levels[1:]))
+
+    def envelope(self, x0, x1, npix):
+        """Line through the min and max of about npix bins between x0 and x1.
+
+        Returns x, y and whether the data were decimated; if there are no
+        more than 2*npix channels in the range they are returned as they are.
+        """
+        x = self.x
+        i0 = max(np.searchsorted(x, x0) - 1, 0)
+        i1 = min(np.searchsorted(x, x1, side='right') + 1, len(x))
+        n = i1 - i0
+        if n <= 2*npix:
+            return x[i0:i1], self.levels[0][0][i0:i1], False
+
+        k = min(int(np.log2(n/npix)), len(self.levels) - 1)
+        lo, hi = self.levels[k]
+        j0, j1 = i0 >> k, min(((i1 - 1) >> k) + 1, len(lo))
+        step = int(np.ceil((j1 - j0)/npix))
+        starts = np.arange(j0, j1, step)
+        bin_lo = np.fmin.reduceat(lo[j0:j1], starts - j0)
+        bin_hi = np.fmax.reduceat(hi[j0:j1], starts - j0)
+
+        # one vertical stroke from min to max at the centre of every bin
+        first = starts << k
+        last = np.minimum(np.append(starts[1:], j1) << k, len(x)) - 1
+        xc = 0.5*(x[first] + x[last])
+        return np.repeat(xc, 2), np.column_stack([bin_lo, bin_hi]).ravel(), True
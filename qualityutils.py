@@ -0,0 +1,135 @@
+import os
+import numpy as np
+from fitviz.batchutils import (iter_tiles, model_spectra, get_panel_chi2_window,
+                               process_pool, _tile_channels, _tile_mask)
+
+
+def _quality_tile(model, wave, popts, data, var, window_tile, wrange, bad_regions,
+                  rescale_noise, nsigma):
+    # reduced chi2, peak |residual| in sigma and lag-1 autocorrelation of
+    # the residuals, over the same channels as _stats_tile
+    npar, ty, tx = popts.shape
+    nspax = ty*tx
+    d = data.reshape(len(wave), nspax).T
+    err2 = var.reshape(len(wave), nspax).T*rescale_noise**2
+    m = model_spectra(model, wave, popts.reshape(npar, nspax), nsigma)
+    mask = _tile_mask(wave, d, m, err2, window_tile, wrange, bad_regions)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        r = np.where(mask, (d - m)/np.sqrt(err2), 0.)
+        n = mask.sum(axis=1)
+        chi2 = (r**2).sum(axis=1)
+        chi2_nu = np.where(n > npar, chi2/(n - npar), np.nan)
+        peak = np.where(n > 0, np.abs(r).max(axis=1), np.nan)
+        # residuals are 0 outside the mask, so only pairs of used channels count
+        autocorr = np.where(n > 1, (r[:, 1:]*r[:, :-1]).sum(axis=1)/chi2, np.nan)
+    return np.array([chi2_nu, peak, autocorr]).reshape(3, ty, tx)
+
+def _disagreement_tile(model_i, model_j, wave, popts_i, popts_j, var, rescale_noise, nsigma):
+    # rms difference of two models in units of the errors
+    ty, tx = popts_i.shape[1:]
+    mi = model_spectra(model_i, wave, popts_i.reshape(popts_i.shape[0], -1), nsigma)
+    mj = model_spectra(model_j, wave, popts_j.reshape(popts_j.shape[0], -1), nsigma)
+    err = np.sqrt(var.reshape(len(wave), -1).T)*rescale_noise
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dm = (mi - mj)/err
+        good = np.isfinite(dm)
+        rms = np.sqrt(np.where(good, dm**2, 0.).sum(axis=1)/good.sum(axis=1))
+    return rms.reshape(ty, tx)
+
+def _fill_maps(maps, names, box, result):
+    y0, y1, x0, x1 = box
+    for name, values in zip(names, result.reshape(len(names), y1 - y0, x1 - x0)):
+        maps[name][y0:y1, x0:x1] = values
+
+def compute_fit_quality(models, model_popts, data, chi2_window, bad_region_masks,
+                        config_params, tile=32, nsigma=5., nproc=None):
+    """Fit-quality maps of every panel, and of every pair of overlapping panels.
+
+    Returns a dict from name to (ny, nx) map: chi2:<ipanel> (reduced chi2),
+    peak:<ipanel> (largest |data - model|/error) and autocorr:<ipanel>
+    (lag-1 autocorrelation of the residuals, near 0 for a good fit), over
+    the channels of compute_fit_stats, and disagree:<ipanel>,<jpanel> for
+    panels whose wavelength ranges overlap (rms difference of the two models
+    over the overlap, in units of the errors). Panels count from 0, as in
+    the map names of the data config. The tiles are computed on nproc
+    spawned processes, or in this thread with nproc=1.
+    """
+    nwave, ny, nx = data.datacube.shape
+    npanels = config_params.npanels
+    wmins, wmaxs = config_params.wmins, config_params.wmaxs
+    rescale_noise = data.errcube.rescale_noise
+    pairs = [(i, j) for i in range(npanels) for j in range(i + 1, npanels)
+             if max(wmins[i], wmins[j]) < min(wmaxs[i], wmaxs[j])]
+
+    maps = {}
+    for ipanel in range(npanels):
+        for kind in ['chi2', 'peak', 'autocorr']:
+            maps['{}:{}'.format(kind, ipanel)] = np.full((ny, nx), np.nan)
+    for i, j in pairs:
+        maps['disagree:{},{}'.format(i, j)] = np.full((ny, nx), np.nan)
+
+    def tasks():
+        # (names, tile, function, arguments), read one tile at a time
+        for y0, y1, x0, x1 in iter_tiles(ny, nx, tile):
+            tile_popts = [np.asarray(p[:, y0:y1, x0:x1], dtype=float) for p in model_popts]
+            for ipanel in range(npanels):
+                window_tile = get_panel_chi2_window(chi2_window, ipanel)
+                if window_tile is not None:
+                    window_tile = np.asarray(window_tile[:, y0:y1, x0:x1], dtype=float)
+                bad_regions = bad_region_masks[ipanel] if len(bad_region_masks) > 0 else []
+                sel = _tile_channels(data.wave, window_tile, (wmins[ipanel], wmaxs[ipanel]))
+                args = (models[ipanel], data.wave[sel], tile_popts[ipanel],
+                        np.asarray(data.datacube[sel, y0:y1, x0:x1], dtype=float),
+                        np.asarray(data.varcube[sel, y0:y1, x0:x1], dtype=float),
+                        window_tile, (wmins[ipanel], wmaxs[ipanel]), bad_regions,
+                        rescale_noise, nsigma)
+                yield (['{}:{}'.format(kind, ipanel) for kind in ['chi2', 'peak', 'autocorr']],
+                       (y0, y1, x0, x1), _quality_tile, args)
+            for i, j in pairs:
+                sel = slice(np.searchsorted(data.wave, max(wmins[i], wmins[j]), side='right'),
+                            np.searchsorted(data.wave, min(wmaxs[i], wmaxs[j])))
+                args = (models[i], models[j], data.wave[sel], tile_popts[i], tile_popts[j],
+                        np.asarray(data.varcube[sel, y0:y1, x0:x1], dtype=float),
+                        rescale_noise, nsigma)
+                yield (['disagree:{},{}'.format(i, j)], (y0, y1, x0, x1), _disagreement_tile, args)
+
+    if nproc is None: nproc = os.cpu_count()
+    if nproc == 1:
+        for names, box, func, args in tasks():
+            _fill_maps(maps, names, box, func(*args))
+    else:
+        with process_pool(nproc) as executor:
+            futures = [(names, box, executor.submit(func, *args)) for names, box, func, args in tasks()]
+            for names, box, future in futures:
+                _fill_maps(maps, names, box, future.result())
+    return maps
+
+class QualityIndex():
+    """Spaxels ranked by each fit-quality map, worst (largest value) first.
+
+    Only the top spaxels with a finite value are kept for each map, as flat
+    int32 indices, so stepping through them is a lookup.
+    """
+    def __init__(self, maps, top=1000):
+        self.names = list(maps)
+        self.shape = next(iter(maps.values())).shape
+        self.order = {}
+        self.values = {}
+        for name, m in maps.items():
+            flat = np.asarray(m, dtype=float).ravel()
+            finite = np.flatnonzero(np.isfinite(flat))
+            order = finite[np.argsort(flat[finite])[::-1][:top]]
+            self.order[name] = order.astype(np.int32)
+            self.values[name] = flat[order]
+
+    def __len__(self):
+        return len(self.names)
+
+    def count(self, name):
+        return len(self.order[name])
+
+    def spaxel(self, name, rank):
+        """(y, x) and value of the spaxel at rank (from 0) of map name."""
+        y, x = np.unravel_index(self.order[name][rank], self.shape)
+        return int(y), int(x), self.values[name][rank]
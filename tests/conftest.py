@@ -0,0 +1,11 @@
+import os
+import sys
+import types
+
+# the modules import each other as fitviz.<module>; register the checkout
+# as that package, whatever the directory it was cloned into is called
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if 'fitviz' not in sys.modules:
+    package = types.ModuleType('fitviz')
+    package.__path__ = [ROOT]
+    sys.modules['fitviz'] = package
@@ -0,0 +1,65 @@
+import numpy as np
+from fitviz.apertureutils import ApertureIndex, direct_sum, ellipse_mask, polygon_mask
+
+
+def make_cubes(nwave=40, ny=30, nx=25, seed=1):
+    rng = np.random.default_rng(seed)
+    data = rng.normal(5., 1., (nwave, ny, nx))
+    var = rng.uniform(0.5, 1., (nwave, ny, nx))
+    data[3, 4, 5] = np.nan
+    var[7, 1:3, 2] = np.nan
+    return data, var
+
+def brute_force(data, var, channels, mask):
+    d, v = data[channels][:, mask], var[channels][:, mask]
+    good = np.isfinite(d) & np.isfinite(v)
+    return np.nansum(np.where(good, d, np.nan), axis=1), np.nansum(np.where(good, v, np.nan), axis=1), good.sum(axis=1)
+
+def check(sums, expected, index=None, nruns=1):
+    flux, var, count = sums
+    flux_tol = var_tol = 1e-10
+    if index is not None:
+        flux_tol, var_tol = nruns*index.flux_error, nruns*index.var_error
+    assert np.all(np.abs(flux - expected[0]) <= flux_tol + 1e-10)
+    assert np.all(np.abs(var - expected[1]) <= var_tol + 1e-10)
+    assert np.array_equal(count, expected[2])
+
+def test_box_sum():
+    data, var = make_cubes()
+    channels = np.r_[2:10, 20:31]
+    index = ApertureIndex(data, var, channels)
+    mask = np.zeros(data.shape[1:], dtype=bool)
+    mask[2:17, 3:20] = True
+    check(index.box_sum(2, 17, 3, 20), brute_force(data, var, channels, mask), index)
+    mask[:] = False
+    mask[6, 7] = True
+    check(index.box_sum(6, 7, 7, 8), brute_force(data, var, channels, mask), index)
+
+def test_mask_sum():
+    data, var = make_cubes()
+    channels = np.r_[2:10, 20:31]
+    index = ApertureIndex(data, var, channels)
+    for mask in [ellipse_mask(data.shape[1:], 2, 20, 3, 25),
+                 polygon_mask(data.shape[1:], [(1, 1), (20, 4), (8, 25)])]:
+        check(index.mask_sum(mask), brute_force(data, var, channels, mask), index, nruns=mask.shape[0])
+
+def test_float64_tables():
+    data, var = make_cubes()
+    channels = np.arange(data.shape[0])
+    index = ApertureIndex(data, var, channels, dtype=np.float64)
+    mask = ellipse_mask(data.shape[1:], 0, 24, 0, 29)
+    flux, var_sum, count = index.mask_sum(mask)
+    expected = brute_force(data, var, channels, mask)
+    assert np.allclose(flux, expected[0], rtol=1e-12)
+    assert np.allclose(var_sum, expected[1], rtol=1e-12)
+
+def test_direct_sum():
+    data, var = make_cubes()
+    channels = np.r_[0:5, 12:40]
+    mask = ellipse_mask(data.shape[1:], 2, 20, 3, 25)
+    check(direct_sum(data, var, channels, mask, nplanes=8), brute_force(data, var, channels, mask))
+
+def test_table_nbytes():
+    data, var = make_cubes()
+    index = ApertureIndex(data, var, np.arange(10))
+    assert index.nbytes == ApertureIndex.table_nbytes(10, data.shape[1:])
@@ -0,0 +1,19 @@
+import numpy as np
+import pytest
+from fitviz.modelutils import O3_2comp
+from fitviz.batchutils import model_spectra
+
+O3_LINES = [4960.295, 5008.240]
+
+
+@pytest.mark.parametrize('name', ['model', 'model_display', 'model_nolsf_display'])
+def test_model_spectra_follows_the_method(name):
+    # the vectorized path is the LSF-convolved model, so it must not stand
+    # in for model_nolsf_display
+    func = getattr(O3_2comp(O3_LINES, [55., 52.]), name)
+    wave = np.linspace(7580, 7700, 500)
+    popts = np.tile([[0.5335, 80., 5., 0.5337, 150., 2.]], (3, 1)).T
+    expected = func(wave, *popts[:, 0])
+    if isinstance(expected, (tuple, list)): expected = expected[0]
+    out = model_spectra(func, wave, popts, nsigma=10.)
+    assert np.allclose(out, expected[None, :], rtol=0, atol=1e-6*np.abs(expected).max())
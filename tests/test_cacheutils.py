@@ -0,0 +1,44 @@
+import numpy as np
+from fitviz.cacheutils import LRUCache, nbytes
+
+
+def block(n):
+    return np.zeros(n, dtype=np.uint8)
+
+def test_nbytes():
+    assert nbytes(block(100)) == 100
+    assert nbytes({'a': block(10), 'b': [block(20), (block(30), 1.)]}) == 68
+
+def test_eviction_by_bytes():
+    cache = LRUCache(max_bytes=1000)
+    for key in range(4):
+        cache.put(key, block(300))
+    # 4 x 300 bytes is over the budget: the oldest entry goes
+    assert 0 not in cache and len(cache) == 3 and cache.nbytes == 900
+    # using an entry makes it the most recent, so the next one is evicted
+    assert cache.get(1) is not None
+    cache.put(4, block(300))
+    assert 1 in cache and 2 not in cache
+    # one large entry evicts as many old ones as it takes
+    cache.put(5, block(700))
+    assert list(cache._entries) == [4, 5] and cache.nbytes == 1000
+    assert cache.hits == 1 and cache.get(0) is None and cache.misses == 1
+
+def test_oversized_and_replaced_entries():
+    cache = LRUCache(max_bytes=1000)
+    cache.put('a', block(400))
+    cache.put('b', block(1001))
+    assert 'b' not in cache and cache.nbytes == 400
+    cache.put('a', block(100))
+    assert cache.nbytes == 100
+    cache.put('c', [1, 2], size=900)
+    assert cache.nbytes == 1000 and len(cache) == 2
+
+def test_clear_drops_stale_values():
+    cache = LRUCache(max_bytes=1000)
+    generation = cache.generation
+    cache.clear()
+    cache.put('a', block(10), generation=generation)
+    assert 'a' not in cache
+    cache.put('a', block(10), generation=cache.generation)
+    assert 'a' in cache
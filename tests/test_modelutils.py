@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+from fitviz.modelutils import O2_1comp, O2_2comp, O3_1comp, O3_3comp
+
+O2_LINES = [3727.092, 3729.875]
+O3_LINES = [4960.295, 5008.240]
+Z0 = 0.5335
+
+# model, line wavelengths, parameters (ratio last for O2) and wavelengths
+CASES = [(O2_1comp, O2_LINES, [Z0, 80., 5., 1.3], np.linspace(5700, 5740, 400)),
+         (O2_2comp, O2_LINES, [Z0, 80., 5., 1.3, Z0 + 5e-4, 150., 2., 0.8], np.linspace(5700, 5740, 400)),
+         (O3_1comp, O3_LINES, [Z0, 80., 5.], np.linspace(7580, 7700, 600)),
+         (O3_3comp, O3_LINES, [Z0, 80., 5., Z0 - 4e-4, 200., 2., Z0 + 3e-4, 40., 1.],
+          np.linspace(7580, 7700, 600))]
+
+@pytest.mark.parametrize('cls, lines, params, x', CASES)
+def test_jacobian_matches_finite_differences(cls, lines, params, x):
+    model = cls(lines, [55., 52.])
+    jac = model.jacobian(x, *params)
+    assert jac.shape == (len(params), len(x))
+    for i, p in enumerate(params):
+        # redshifts are the first parameter of every component
+        h = 1e-7 if i % model.npar_comp == 0 else 1e-4*abs(p)
+        up, down = list(params), list(params)
+        up[i] += h
+        down[i] -= h
+        numeric = (model.model(x, *up) - model.model(x, *down))/(2*h)
+        scale = np.abs(numeric).max()
+        assert np.allclose(jac[i], numeric, rtol=0, atol=1e-5*scale)
@@ -0,0 +1,42 @@
+import numpy as np
+from fitviz.pyramidutils import SpectralPyramid
+
+
+def make_spectrum(n=3701, seed=2):
+    rng = np.random.default_rng(seed)
+    y = rng.normal(0., 1., n)
+    y[[5, 100, 101, 2000]] = np.nan
+    return np.arange(n, dtype=float), y
+
+def bins_of(xe):
+    # first and last channel of every bin, from the bin centres; with x =
+    # arange(n) all bins but the last are w channels wide
+    xc = xe[0::2]
+    w = int(round(xc[1] - xc[0]))
+    first = (xc[0] - 0.5*(w - 1) + w*np.arange(len(xc))).astype(int)
+    last = (2*xc - first).astype(int)
+    return first, last
+
+def test_envelope_matches_raw_decimation():
+    x, y = make_spectrum()
+    pyramid = SpectralPyramid(x, y)
+    for x0, x1, npix in [(0, 3700, 200), (123.4, 2950.1, 300), (1000, 1900, 50), (0, 3700, 7)]:
+        xe, ye, decimated = pyramid.envelope(x0, x1, npix)
+        assert decimated
+        first, last = bins_of(xe)
+        assert np.array_equal(first[1:], last[:-1] + 1)
+        assert first[0] <= x0 and last[-1] >= x1
+        assert len(first) <= npix + 1
+        lo, hi = ye[0::2], ye[1::2]
+        for f, l, blo, bhi in zip(first, last, lo, hi):
+            with np.errstate(all='ignore'):
+                assert np.array_equal(blo, np.nanmin(y[f:l+1]), equal_nan=True)
+                assert np.array_equal(bhi, np.nanmax(y[f:l+1]), equal_nan=True)
+
+def test_short_range_is_not_decimated():
+    x, y = make_spectrum()
+    pyramid = SpectralPyramid(x, y)
+    xe, ye, decimated = pyramid.envelope(500, 700, 200)
+    assert not decimated
+    assert np.array_equal(xe, x[499:702])
+    assert np.array_equal(ye, y[499:702], equal_nan=True)
@@ -0,0 +1,106 @@
+import os
+import time
+import pstats
+import cProfile
+import logging
+import threading
+from logging.handlers import RotatingFileHandler
+from contextlib import contextmanager
+from collections import OrderedDict
+
+
+class StageTimer():
+    """Per-stage wall-clock times of one interaction (a click, the startup).
+
+    start() begins a new interaction, stage(name) times a block of code and
+    adds it to that stage, and finish() returns a one-line summary and
+    writes it to a rolling log file (log_fname, None for no log). Stages
+    entered from other threads, e.g. by the prefetcher, are not counted,
+    except for the threads passed to start() that work on the interaction.
+    """
+    def __init__(self, log_fname=None, max_bytes=2**20, backup_count=3):
+        self.label = None
+        self.stages = OrderedDict()
+        self.last = OrderedDict()
+        self.last_total = 0.
+        self._threads = set()
+        self.logger = None
+        if log_fname is not None:
+            self.logger = logging.getLogger('fitviz.timing')
+            self.logger.setLevel(logging.INFO)
+            self.logger.propagate = False
+            # the logger is shared by all timers, so every file gets one handler
+            path = os.path.abspath(log_fname)
+            if not any(getattr(h, 'baseFilename', None) == path for h in self.logger.handlers):
+                handler = RotatingFileHandler(path, maxBytes=max_bytes,
+                                              backupCount=backup_count)
+                handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+                self.logger.addHandler(handler)
+
+    def start(self, label, threads=()):
+        self.label = label
+        self.stages = OrderedDict()
+        self._threads = {threading.get_ident()} | set(threads)
+        self._t0 = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        if threading.get_ident() not in self._threads:
+            yield
+            return
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.) + time.perf_counter() - t0
+
+    def finish(self):
+        self.last_total = time.perf_counter() - self._t0
+        self.last = self.stages
+        self._threads = set()
+        summary = self.summary()
+        if self.logger is not None:
+            self.logger.info(summary)
+        return summary
+
+    def summary(self):
+        parts = ['{}: {:.1f} ms'.format(self.label, self.last_total*1e3)]
+        parts += ['{} {:.1f}'.format(name, dt*1e3) for name, dt in self.last.items()]
+        return ' | '.join(parts)
+
+class InteractionProfiler():
+    """cProfile capture of the next n interactions.
+
+    start(n) begins a capture, tick() is called after every interaction and
+    stop() (called by tick() after n interactions) dumps the stats to a
+    .prof file and returns its name.
+    """
+    def __init__(self, prefix='fitviz_profile'):
+        self.prefix = prefix
+        self.profile = None
+        self.remaining = 0
+
+    @property
+    def active(self):
+        return self.profile is not None
+
+    def start(self, n):
+        self.profile = cProfile.Profile()
+        self.remaining = n
+        self.profile.enable()
+
+    def tick(self):
+        if not self.active:
+            return None
+        self.remaining -= 1
+        if self.remaining <= 0:
+            return self.stop()
+        return None
+
+    def stop(self, nlines=20):
+        self.profile.disable()
+        fname = '{}_{}.prof'.format(self.prefix, time.strftime('%Y%m%d_%H%M%S'))
+        self.profile.dump_stats(fname)
+        pstats.Stats(self.profile).sort_stats('cumulative').print_stats(nlines)
+        self.profile = None
+        return fname